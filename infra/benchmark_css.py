@@ -0,0 +1,167 @@
+#!/usr/bin/env python3
+
+"""
+Time CSSParser on generated stylesheets from 1 KB to 10 MB, comparing
+the scanning tokenizer in lab15 to the old character-by-character one,
+and time restyling elements with inline styles with and without the
+inline style cache.
+Run from the repository root: `python3 infra/benchmark_css.py`.
+"""
+
+import os, sys
+import time
+
+SIZES = [1_000, 10_000, 100_000, 1_000_000, 10_000_000]
+
+RULE = """
+section h2, div p {{
+  margin-left: {n}px;
+  margin-right: 4px;
+  padding-top: 2px;
+  font-family: 'Helvetica Neue', sans-serif;
+  font-size: 120%;
+  background-color: lightblue;
+  transition: opacity 2s;
+}}
+"""
+
+# Every tenth rule has a bad declaration and a media query, to
+# exercise error recovery
+ODD_RULE = """
+@media (prefers-color-scheme: dark) {{ p {{ color: white; bad: }} }}
+a:focus {{ outline: 1px solid red; this is not a declaration; }}
+"""
+
+INLINE = "<p style='margin-left: {n}px; color: blue; font-size: 110%'>" + \
+    "Paragraph</p>"
+INLINE_STYLES = 10
+PARAGRAPHS = 2_000
+
+def make_stylesheet(size):
+    parts = []
+    length = 0
+    n = 0
+    while length < size:
+        text = RULE.format(n=n)
+        if n % 10 == 0: text += ODD_RULE.format(n=n)
+        parts.append(text)
+        length += len(text)
+        n += 1
+    return "".join(parts)
+
+def best_time(f, repeat):
+    best = None
+    for i in range(repeat):
+        start = time.perf_counter()
+        result = f()
+        elapsed = time.perf_counter() - start
+        if best is None or elapsed < best: best = elapsed
+    return best, result
+
+def main(max_size):
+    os.chdir(os.path.join(os.path.dirname(os.path.abspath(__file__)), "../src"))
+    sys.path.insert(0, os.getcwd())
+    import lab15
+
+    class CharacterParser(lab15.CSSParser):
+        def whitespace(self):
+            while self.i < len(self.s) and self.s[self.i].isspace():
+                self.i += 1
+
+        def word(self):
+            start = self.i
+            in_quote = False
+            while self.i < len(self.s):
+                cur = self.s[self.i]
+                if cur == "'":
+                    in_quote = not in_quote
+                if cur.isalnum() or cur in ",/#-.%()\"'" \
+                    or (in_quote and cur == ':'):
+                    self.i += 1
+                else:
+                    break
+            if not (self.i > start):
+                raise Exception("Parsing error")
+            return self.s[start:self.i]
+
+        def until_chars(self, chars):
+            start = self.i
+            while self.i < len(self.s) and self.s[self.i] not in chars:
+                self.i += 1
+            return self.s[start:self.i]
+
+        def ignore_until(self, chars):
+            while self.i < len(self.s):
+                if self.s[self.i] in chars:
+                    return self.s[self.i]
+                else:
+                    self.i += 1
+            return None
+
+        def body(self):
+            pairs = {}
+            while self.i < len(self.s) and self.s[self.i] != "}":
+                try:
+                    prop, val = self.pair([";", "}"])
+                    pairs[prop] = val
+                    self.whitespace()
+                    self.literal(";")
+                    self.whitespace()
+                except Exception:
+                    why = self.ignore_until([";", "}"])
+                    if why == ";":
+                        self.literal(";")
+                        self.whitespace()
+                    else:
+                        break
+            return pairs
+
+    print("{:>10}  {:>8}  {:>10}  {:>10}  {:>8}".format(
+        "bytes", "rules", "old MB/s", "new MB/s", "speedup"))
+    for size in SIZES:
+        if size > max_size: break
+        sheet = make_stylesheet(size)
+        repeat = 5 if size <= 1_000_000 else 1
+        old_time, old_rules = best_time(
+            lambda: CharacterParser(sheet).parse(), repeat)
+        new_time, new_rules = best_time(
+            lambda: lab15.CSSParser(sheet).parse(), repeat)
+        assert repr(old_rules) == repr(new_rules), \
+            "Parsers disagree on a {} byte stylesheet".format(size)
+        mb = len(sheet) / 1_000_000
+        print("{:>10}  {:>8}  {:>10.2f}  {:>10.2f}  {:>7.1f}x".format(
+            len(sheet), len(new_rules), mb / old_time, mb / new_time,
+            old_time / new_time))
+
+    class Tab:
+        dark_mode = False
+
+    class Frame:
+        def __init__(self):
+            self.tab = Tab()
+            self.ancestors = lab15.AncestorFilter()
+
+    body = "".join(INLINE.format(n=n % INLINE_STYLES)
+        for n in range(PARAGRAPHS))
+    elements = [node for node in lab15.tree_to_list(
+        lab15.HTMLParser(body).parse(), [])
+        if isinstance(node, lab15.Element) and node.tag == "p"]
+    rules = lab15.RuleIndex([])
+    old_time, old_values = best_time(lambda: [
+        CharacterParser(node.attributes["style"]).body()
+        for node in elements], 5)
+    new_time, new_values = best_time(lambda: [
+        lab15.cascaded_values(node, rules, Frame())
+        for node in elements], 5)
+    assert old_values == new_values, "Inline styles differ"
+    print("{} inline styles: {:.1f} ms parsing each time, "
+        "{:.1f} ms cached ({})".format(len(elements), old_time * 1000,
+            new_time * 1000, lab15.INLINE_STYLES))
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description="Benchmark CSSParser")
+    parser.add_argument("--max-size", type=int, default=SIZES[-1],
+        help="Largest stylesheet to parse, in bytes")
+    args = parser.parse_args()
+    main(args.max_size)
@@ -0,0 +1,101 @@
+#!/usr/bin/env python3
+
+"""
+Measure how much memory each DOM node takes in lab16, comparing
+compact nodes (interned names, shared empty children, style and
+animations) to nodes that allocate their own lists and dictionaries.
+Run from the repository root: `python3 infra/benchmark_dom.py`.
+"""
+
+import os, sys
+import gc
+import tracemalloc
+from unittest import mock
+
+SIZES = [10_000, 100_000, 1_000_000, 10_000_000]
+
+SECTION = """
+<div class="section" id="s{n}">
+  <h2 class="title">Section {n}</h2>
+  <p class="body">Some <b>bold</b> and <i>italic</i> text, with a
+  <a href="/page{n}.html" class="link">link</a> and an image
+  <img src="/img{n}.png" width=10>, spread over a few lines.</p>
+  <ul><li>One</li><li>Two</li><li>Three</li></ul>
+</div>
+"""
+
+def make_document(size):
+    parts = ["<!doctype html><html><head><title>Benchmark</title>",
+             "<link rel=stylesheet href=style.css></head><body>"]
+    length = sum(len(part) for part in parts)
+    n = 0
+    while length < size:
+        text = SECTION.format(n=n)
+        parts.append(text)
+        length += len(text)
+        n += 1
+    parts.append("</body></html>")
+    return "".join(parts)
+
+def count(node):
+    return 1 + sum(count(child) for child in node.children)
+
+def measure(parser_class, body):
+    gc.collect()
+    tracemalloc.start()
+    tree = parser_class(body).parse()
+    gc.collect()
+    size, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return size, tree
+
+def main(max_size):
+    os.chdir(os.path.join(os.path.dirname(os.path.abspath(__file__)), "../src"))
+    sys.path.insert(0, os.getcwd())
+    import lab16
+
+    def element_init(self, tag, attributes, parent):
+        self.tag = tag
+        self.attributes = attributes
+        self.children = []
+        self.parent = parent
+        self.style = None
+        self.animations = {}
+        self.is_focused = False
+        self.layout_object = None
+
+    def text_init(self, text, parent):
+        self.text = text
+        self.children = []
+        self.parent = parent
+        self.style = None
+        self.animations = {}
+        self.is_focused = False
+        self.layout_object = None
+
+    print("{:>10}  {:>8}  {:>10}  {:>10}  {:>8}".format(
+        "bytes", "nodes", "old B/node", "new B/node", "saved"))
+    for size in SIZES:
+        if size > max_size: break
+        body = make_document(size)
+        with mock.patch.object(lab16.Element, "__init__", element_init), \
+             mock.patch.object(lab16.Text, "__init__", text_init), \
+             mock.patch("sys.intern", lambda s: s):
+            old_size, old_tree = measure(lab16.HTMLParser, body)
+        nodes = count(old_tree)
+        del old_tree
+        new_size, new_tree = measure(lab16.HTMLParser, body)
+        assert count(new_tree) == nodes, \
+            "Trees differ on a {} byte document".format(size)
+        del new_tree
+        print("{:>10}  {:>8}  {:>10.0f}  {:>10.0f}  {:>7.0%}".format(
+            len(body), nodes, old_size / nodes, new_size / nodes,
+            1 - new_size / old_size))
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description="Benchmark DOM node memory")
+    parser.add_argument("--max-size", type=int, default=SIZES[-1],
+        help="Largest document to parse, in bytes")
+    args = parser.parse_args()
+    main(args.max_size)
@@ -0,0 +1,98 @@
+#!/usr/bin/env python3
+
+"""
+Time HTMLParser on generated documents from 1 KB to 10 MB, comparing
+the scanning tokenizer in lab15 to the old character-by-character one.
+Run from the repository root: `python3 infra/benchmark_parser.py`.
+"""
+
+import os, sys
+import time
+
+SIZES = [1_000, 10_000, 100_000, 1_000_000, 10_000_000]
+
+MARKUP = """
+<div class="section" id="s{n}">
+  <h2>Section {n}</h2>
+  <p>Some <b>bold</b> and <i>italic</i> text, with a
+  <a href="/page{n}.html">link</a> and an image
+  <img src="/img{n}.png" width=10>, spread over a few lines.</p>
+  <ul><li>One</li><li>Two</li><li>Three</li></ul>
+</div>
+"""
+
+PROSE = "<h2>Chapter {n}</h2>\n<p>" + \
+    "All work and no play makes for a long paragraph. " * 80 + "</p>\n"
+
+DOCUMENTS = {"markup": MARKUP, "prose": PROSE}
+
+def make_document(size, section):
+    parts = ["<!doctype html><html><head><title>Benchmark</title>",
+             "<link rel=stylesheet href=style.css></head><body>"]
+    length = sum(len(part) for part in parts)
+    n = 0
+    while length < size:
+        text = section.format(n=n)
+        parts.append(text)
+        length += len(text)
+        n += 1
+    parts.append("</body></html>")
+    return "".join(parts)
+
+def dump(node, out):
+    out.append(repr(node))
+    for child in node.children:
+        dump(child, out)
+    return out
+
+def best_time(parser_class, body, repeat):
+    best = None
+    for i in range(repeat):
+        start = time.perf_counter()
+        tree = parser_class(body).parse()
+        elapsed = time.perf_counter() - start
+        if best is None or elapsed < best: best = elapsed
+    return best, tree
+
+def main(max_size):
+    os.chdir(os.path.join(os.path.dirname(os.path.abspath(__file__)), "../src"))
+    sys.path.insert(0, os.getcwd())
+    import lab15
+
+    class CharacterParser(lab15.HTMLParser):
+        def feed(self, data):
+            for c in data:
+                if c == "<":
+                    self.in_tag = True
+                    if self.text: self.add_text(self.text)
+                    self.text = ""
+                elif c == ">":
+                    self.in_tag = False
+                    self.add_tag(self.text)
+                    self.text = ""
+                else:
+                    self.text += c
+
+    print("{:>8}  {:>10}  {:>10}  {:>10}  {:>8}".format(
+        "document", "bytes", "old MB/s", "new MB/s", "speedup"))
+    for name, section in DOCUMENTS.items():
+        for size in SIZES:
+            if size > max_size: break
+            body = make_document(size, section)
+            repeat = 5 if size <= 1_000_000 else 1
+            old_time, old_tree = best_time(CharacterParser, body, repeat)
+            new_time, new_tree = best_time(lab15.HTMLParser, body, repeat)
+            assert dump(old_tree, []) == dump(new_tree, []), \
+                "Parsers disagree on a {} byte document".format(size)
+            mb = len(body) / 1_000_000
+            print("{:>8}  {:>10}  {:>10.2f}  {:>10.2f}  {:>7.1f}x".format(
+                name, len(body), mb / old_time, mb / new_time,
+                old_time / new_time))
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description="Benchmark HTMLParser")
+    parser.add_argument("--max-size", type=int, default=SIZES[-1],
+        help="Largest document to parse, in bytes")
+    args = parser.parse_args()
+    main(args.max_size)
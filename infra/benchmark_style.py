@@ -0,0 +1,130 @@
+#!/usr/bin/env python3
+
+"""
+Time lab15's style pass with stylesheets of thousands of rules,
+comparing the rule index and style sharing to testing every rule
+against every node, and report how many descendant selectors the
+ancestor filter rejects and how many elements share their style.
+Then compare the memory computed styles take when interned to giving
+each node its own dictionary.
+Run from the repository root: `python3 infra/benchmark_style.py`.
+"""
+
+import os, sys
+import random
+import time
+
+RULE_COUNTS = [100, 1_000, 5_000, 20_000]
+SECTIONS = 200
+
+TAGS = ["div", "p", "span", "a", "b", "i", "ul", "li", "h1", "h2",
+        "section", "article", "nav", "header", "footer", "em", "code",
+        "pre", "small", "big", "table", "tr", "td", "form", "label"]
+
+SECTION = """
+<section><h2>Section {n}</h2>
+  <p>Some <b>bold</b> and <i>italic</i> text, with a <a href=#>link</a>
+  and <code>code</code>.</p>
+  <ul><li>One</li><li><em>Two</em></li><li><span>Three</span></li></ul>
+</section>
+"""
+
+def make_stylesheet(count, rng):
+    rules = []
+    for n in range(count):
+        selector = " ".join(rng.sample(TAGS, rng.choice([1, 1, 2, 3])))
+        rules.append("{} {{ margin-left: {}px; color: c{}; }}".format(
+            selector, n % 10, n))
+    return "\n".join(rules)
+
+def make_document():
+    return "<html><body>" + \
+        "".join(SECTION.format(n=n) for n in range(SECTIONS)) + \
+        "</body></html>"
+
+def dump(node, out):
+    out.append(sorted(node.style.items()))
+    for child in node.children:
+        dump(child, out)
+    return out
+
+def main(max_rules):
+    os.chdir(os.path.join(os.path.dirname(os.path.abspath(__file__)), "../src"))
+    sys.path.insert(0, os.getcwd())
+    import lab15
+
+    class AllRules:
+        def __init__(self, rules):
+            self.rules = rules
+
+        def candidates(self, node):
+            return self.rules
+
+    class NoSharing(lab15.StyleSharingCache):
+        def lookup(self, node):
+            return None
+
+    class Tab:
+        dark_mode = False
+
+    class Frame:
+        def __init__(self, sharing_class):
+            self.tab = Tab()
+            self.ancestors = lab15.AncestorFilter()
+            self.style_sharing = sharing_class()
+
+    def best_time(rule_class, sharing_class, rules, repeat):
+        best = None
+        for i in range(repeat):
+            nodes = lab15.HTMLParser(make_document()).parse()
+            frame = Frame(sharing_class)
+            start = time.perf_counter()
+            lab15.style(nodes, rule_class(rules), frame)
+            elapsed = time.perf_counter() - start
+            if best is None or elapsed < best: best = elapsed
+        return best, nodes, frame
+
+    def style_memory(nodes):
+        styles = {}
+        old_size = 0
+        for node in lab15.tree_to_list(nodes, []):
+            styles[id(node.style)] = node.style
+            old_size += sys.getsizeof(dict(node.style))
+        new_size = sum(sys.getsizeof(style) for style in styles.values())
+        return old_size, new_size, len(styles)
+
+    rng = random.Random(0)
+    nodes = len(lab15.tree_to_list(
+        lab15.HTMLParser(make_document()).parse(), []))
+    print("{} nodes".format(nodes))
+    print("{:>8}  {:>10}  {:>10}  {:>8}  {:>8}  {:>8}".format(
+        "rules", "old ms", "new ms", "speedup", "rejected", "shared"))
+    for count in RULE_COUNTS:
+        if count > max_rules: break
+        sheet = make_stylesheet(count, rng)
+        rules = sorted(lab15.CSSParser(sheet).parse(),
+            key=lab15.cascade_priority)
+        repeat = 3 if count <= 1_000 else 1
+        old_time, old_nodes, frame = \
+            best_time(AllRules, NoSharing, rules, repeat)
+        new_time, new_nodes, frame = best_time(
+            lab15.RuleIndex, lab15.StyleSharingCache, rules, repeat)
+        assert dump(old_nodes, []) == dump(new_nodes, []), \
+            "Styles differ with {} rules".format(count)
+        print("{:>8}  {:>10.1f}  {:>10.1f}  {:>7.1f}x  {:>8.0%}  {:>8.0%}"
+            .format(count, old_time * 1000, new_time * 1000,
+                old_time / new_time, frame.ancestors.reject_rate(),
+                frame.style_sharing.share_rate()))
+
+    old_size, new_size, records = style_memory(new_nodes)
+    print("style memory: {:.0f} B/node in private dicts, "
+        "{:.1f} B/node in {} interned records".format(
+            old_size / nodes, new_size / nodes, records))
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description="Benchmark style()")
+    parser.add_argument("--max-rules", type=int, default=RULE_COUNTS[-1],
+        help="Largest stylesheet to try, in rules")
+    args = parser.parse_args()
+    main(args.max_rules)
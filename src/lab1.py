@@ -33,6 +33,26 @@ class URL:
             self.__init__("https://browser.engineering")
 
     def request(self):
+        s, response = self.send_request()
+        content = response.read()
+        s.close()
+    
+        return content
+
+    @wbetools.js_hide
+    def stream(self, block_size=64 * 1024):
+        # Like request, but yields the body a block at a time, so huge
+        # pages never have to fit in memory at once
+        s, response = self.send_request()
+        try:
+            while True:
+                block = response.read(block_size)
+                if not block: break
+                yield block
+        finally:
+            s.close()
+
+    def send_request(self):
         s = socket.socket(
             family=socket.AF_INET,
             type=socket.SOCK_STREAM,
@@ -63,11 +83,8 @@ class URL:
     
         assert "transfer-encoding" not in response_headers
         assert "content-encoding" not in response_headers
-    
-        content = response.read()
-        s.close()
-    
-        return content
+
+        return s, response
 
     @wbetools.js_hide
     def __repr__(self):
@@ -84,6 +101,18 @@ def show(body):
         elif not in_tag:
             print(c, end="")
 
+@wbetools.js_hide
+def show_stream(blocks):
+    # Every "<" enters a tag and every ">" leaves one, just like show,
+    # but whole runs of text are printed at once
+    in_tag = False
+    for block in blocks:
+        for i, chunk in enumerate(block.split("<")):
+            if i > 0: in_tag = True
+            for j, piece in enumerate(chunk.split(">")):
+                if j > 0: in_tag = False
+                if not in_tag: print(piece, end="")
+
 def load(url):
     body = url.request()
     show(body)
@@ -5,8 +5,11 @@ without exercises.
 """
 
 import sys
+import codecs
 import ctypes
 import dukpy
+import hashlib
+import json
 import math
 import os
 import sdl2
@@ -16,6 +19,7 @@ import ssl
 import threading
 import time
 import urllib.parse
+import zlib
 import wbetools
 import OpenGL.GL
 
@@ -46,69 +50,1020 @@ from lab14 import parse_outline, paint_outline, \
     AccessibilityNode, PseudoclassSelector
 from lab14 import DocumentLayout, BlockLayout, LineLayout, TextLayout
 
+MAX_IDLE_CONNECTIONS_PER_HOST = 6
+CONNECTION_IDLE_TIMEOUT_SEC = 30
+
+class ConnectionPool:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.idle = {}
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def checkout(self, key):
+        self.lock.acquire(blocking=True)
+        self.evict_idle()
+        s = None
+        sockets = self.idle.get(key, [])
+        if sockets:
+            s, last_used = sockets.pop()
+            self.hits += 1
+        else:
+            self.misses += 1
+        self.lock.release()
+        return s
+
+    def checkin(self, key, s):
+        self.lock.acquire(blocking=True)
+        if key not in self.idle:
+            self.idle[key] = []
+        sockets = self.idle[key]
+        if len(sockets) < MAX_IDLE_CONNECTIONS_PER_HOST:
+            sockets.append((s, time.time()))
+            s = None
+        else:
+            self.evictions += 1
+        self.lock.release()
+        if s: s.close()
+
+    def evict_idle(self):
+        now = time.time()
+        for key, sockets in self.idle.items():
+            fresh = []
+            for s, last_used in sockets:
+                if now - last_used > CONNECTION_IDLE_TIMEOUT_SEC:
+                    s.close()
+                    self.evictions += 1
+                else:
+                    fresh.append((s, last_used))
+            self.idle[key] = fresh
+
+    @wbetools.js_hide
+    def __repr__(self):
+        idle = sum([len(sockets) for sockets in self.idle.values()])
+        return "ConnectionPool(hits={}, misses={}, evictions={}, idle={})" \
+            .format(self.hits, self.misses, self.evictions, idle)
+
+CONNECTION_POOL = ConnectionPool()
+
+DNS_CACHE_TTL_SEC = 60
+
+class DNSCache:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.entries = {}
+        self.hits = 0
+        self.misses = 0
+        self.lookup_time = 0
+
+    def resolve(self, host, port):
+        key = host + ":" + str(port)
+        self.lock.acquire(blocking=True)
+        address, expires = self.entries.get(key, (None, 0))
+        if time.time() < expires:
+            self.hits += 1
+        else:
+            address = None
+        self.lock.release()
+        if address: return address
+
+        start = time.time()
+        infos = socket.getaddrinfo(host, port,
+            socket.AF_INET, socket.SOCK_STREAM)
+        address = infos[0][4]
+        elapsed = time.time() - start
+
+        self.lock.acquire(blocking=True)
+        self.entries[key] = (address, time.time() + DNS_CACHE_TTL_SEC)
+        self.misses += 1
+        self.lookup_time += elapsed
+        self.lock.release()
+        return address
+
+    def time_saved(self):
+        if not self.misses: return 0
+        return self.hits * self.lookup_time / self.misses
+
+    @wbetools.js_hide
+    def __repr__(self):
+        return "DNSCache(hits={}, misses={}, entries={})" \
+            .format(self.hits, self.misses, len(self.entries))
+
+DNS_CACHE = DNSCache()
+
+class TLSSessionCache:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.context = None
+        self.sessions = {}
+        self.full_handshakes = 0
+        self.resumed_handshakes = 0
+        self.full_time = 0
+        self.resumed_time = 0
+
+    def get_context(self):
+        self.lock.acquire(blocking=True)
+        if not self.context:
+            self.context = ssl.create_default_context()
+        ctx = self.context
+        self.lock.release()
+        return ctx
+
+    def wrap(self, s, host, port):
+        ctx = self.get_context()
+        key = host + ":" + str(port)
+        self.lock.acquire(blocking=True)
+        session = self.sessions.get(key)
+        self.lock.release()
+
+        start = time.time()
+        s = ctx.wrap_socket(s, server_hostname=host, session=session)
+        elapsed = time.time() - start
+
+        self.lock.acquire(blocking=True)
+        if s.session_reused:
+            self.resumed_handshakes += 1
+            self.resumed_time += elapsed
+        else:
+            self.full_handshakes += 1
+            self.full_time += elapsed
+        self.lock.release()
+        return s
+
+    def remember(self, s, host, port):
+        # TLS 1.3 servers send session tickets after the handshake,
+        # so only save the session once a response has been read
+        if not s.session: return
+        key = host + ":" + str(port)
+        self.lock.acquire(blocking=True)
+        self.sessions[key] = s.session
+        self.lock.release()
+
+    def time_saved(self):
+        if not self.full_handshakes: return 0
+        average = self.full_time / self.full_handshakes
+        return self.resumed_handshakes * average - self.resumed_time
+
+    @wbetools.js_hide
+    def __repr__(self):
+        return "TLSSessionCache(full={}, resumed={}, sessions={})" \
+            .format(self.full_handshakes, self.resumed_handshakes,
+                    len(self.sessions))
+
+TLS_SESSIONS = TLSSessionCache()
+
+BODY_BLOCK_SIZE = 64 * 1024
+
+class ContentDecoder:
+    def __init__(self, encoding, receiver=None):
+        self.encoding = encoding
+        self.receiver = receiver
+        self.chunks = []
+        self.started = False
+        if encoding == "gzip":
+            self.decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        elif encoding == "deflate":
+            self.decompressor = zlib.decompressobj()
+        else:
+            assert encoding in ["", "identity"], \
+                "Unsupported content-encoding " + encoding
+            self.decompressor = None
+
+    def feed(self, data):
+        if self.decompressor:
+            if self.encoding == "deflate" and not self.started:
+                # Some servers send raw deflate data without a zlib header
+                try:
+                    data = self.decompressor.decompress(data)
+                except zlib.error:
+                    self.decompressor = zlib.decompressobj(-zlib.MAX_WBITS)
+                    data = self.decompressor.decompress(data)
+            else:
+                data = self.decompressor.decompress(data)
+        self.started = True
+        self.emit(data)
+
+    def emit(self, data):
+        if not data: return
+        self.chunks.append(data)
+        if self.receiver: self.receiver.receive(data)
+
+    def finish(self):
+        if self.decompressor:
+            self.emit(self.decompressor.flush())
+        return b"".join(self.chunks)
+
+def read_length(response, length, decoder):
+    while length > 0:
+        block = response.read(min(length, BODY_BLOCK_SIZE))
+        assert block, "Connection closed before end of body"
+        decoder.feed(block)
+        length -= len(block)
+
+def read_chunked(response, decoder):
+    while True:
+        line = response.readline().decode("utf8")
+        size = int(line.split(";", 1)[0].strip(), 16)
+        if size == 0: break
+        read_length(response, size, decoder)
+        response.readline()
+    while True:
+        line = response.readline()
+        if line == b"\r\n" or not line: break
+
+def read_to_close(response, decoder):
+    while True:
+        block = response.read(BODY_BLOCK_SIZE)
+        if not block: break
+        decoder.feed(block)
+
+def parse_cache_control(value):
+    directives = {}
+    for directive in value.split(","):
+        directive = directive.strip().casefold()
+        if not directive: continue
+        if "=" in directive:
+            name, arg = directive.split("=", 1)
+            directives[name.strip()] = arg.strip().strip('"')
+        else:
+            directives[directive] = ""
+    return directives
+
+class CacheEntry:
+    def __init__(self, headers, body, stored_at):
+        self.headers = headers
+        self.body = body
+        self.stored_at = stored_at
+
+    def max_age(self):
+        directives = parse_cache_control(
+            self.headers.get("cache-control", ""))
+        if "no-cache" in directives: return 0
+        max_age = directives.get("max-age", "0")
+        if not max_age.isdigit(): return 0
+        return int(max_age)
+
+    def is_fresh(self):
+        return time.time() - self.stored_at < self.max_age()
+
+    def add_validators(self, request):
+        if "etag" in self.headers:
+            request += "If-None-Match: {}\r\n".format(self.headers["etag"])
+        if "last-modified" in self.headers:
+            request += "If-Modified-Since: {}\r\n".format(
+                self.headers["last-modified"])
+        return request
+
+HTTP_CACHE_MEMORY_ENTRIES = 64
+HTTP_CACHE_DISK_BYTES = 64 * 1024 * 1024
+
+# Cached responses can be personal, so each profile keeps its own
+def http_cache_directory(profile):
+    return os.path.join(profile, "http-cache")
+
+class HttpCache:
+    def __init__(self, directory):
+        self.directory = directory
+        self.lock = threading.Lock()
+        self.memory = {}
+        self.disk_bytes = None
+        self.requests = 0
+        self.hits = 0
+        self.revalidations = 0
+        self.bytes_saved = 0
+
+    def is_cacheable(self, headers):
+        directives = parse_cache_control(headers.get("cache-control", ""))
+        if "no-store" in directives: return False
+        if "vary" in headers and \
+            headers["vary"].casefold() != "accept-encoding":
+            return False
+        return "max-age" in directives or \
+            "etag" in headers or "last-modified" in headers
+
+    def lookup(self, key):
+        self.lock.acquire(blocking=True)
+        self.requests += 1
+        entry = self.memory.pop(key, None)
+        if entry: self.memory[key] = entry
+        self.lock.release()
+        if not entry and self.directory:
+            entry = self.read_disk(key)
+            if entry: self.remember(key, entry)
+        return entry
+
+    def store(self, key, headers, body):
+        if not self.is_cacheable(headers):
+            self.evict(key)
+            return
+        # Bodies are stored decoded, so the stored headers have to
+        # describe the decoded bytes
+        headers = dict([
+            (header, value) for header, value in headers.items()
+            if header not in ["content-encoding", "transfer-encoding"]
+        ])
+        headers["content-length"] = str(len(body))
+        entry = CacheEntry(headers, body, time.time())
+        self.remember(key, entry)
+        if self.directory:
+            self.write_disk(key, entry)
+
+    def revalidated(self, key, entry, headers):
+        # Other threads may be reading the entry, so its headers are
+        # replaced, never changed in place
+        self.lock.acquire(blocking=True)
+        new_headers = entry.headers.copy()
+        for header, value in headers.items():
+            if header not in ["content-length", "transfer-encoding",
+                "content-encoding"]:
+                new_headers[header] = value
+        entry.headers = new_headers
+        entry.stored_at = time.time()
+        self.revalidations += 1
+        self.bytes_saved += len(entry.body)
+        self.lock.release()
+        if self.directory:
+            self.write_disk(key, entry)
+        return new_headers.copy()
+
+    def served(self, entry):
+        self.lock.acquire(blocking=True)
+        self.hits += 1
+        self.bytes_saved += len(entry.body)
+        self.lock.release()
+
+    def remember(self, key, entry):
+        self.lock.acquire(blocking=True)
+        self.memory.pop(key, None)
+        self.memory[key] = entry
+        while len(self.memory) > HTTP_CACHE_MEMORY_ENTRIES:
+            oldest = next(iter(self.memory))
+            self.memory.pop(oldest)
+        self.lock.release()
+
+    def evict(self, key):
+        self.lock.acquire(blocking=True)
+        self.memory.pop(key, None)
+        self.lock.release()
+        if self.directory:
+            self.erase_disk(key)
+
+    def hit_ratio(self):
+        if not self.requests: return 0
+        return (self.hits + self.revalidations) / self.requests
+
+    @wbetools.js_hide
+    def disk_path(self, key):
+        name = hashlib.sha256(key.encode("utf8")).hexdigest()
+        return os.path.join(self.directory, name)
+
+    @wbetools.js_hide
+    def read_disk(self, key):
+        try:
+            path = self.disk_path(key)
+            with open(path, "rb") as f:
+                meta = json.loads(f.readline().decode("utf8"))
+                body = f.read()
+            # Reads count as uses, so trimming drops the least recent
+            os.utime(path)
+        except (OSError, ValueError):
+            return None
+        if meta["key"] != key: return None
+        return CacheEntry(meta["headers"], body, meta["stored_at"])
+
+    @wbetools.js_hide
+    def erase_disk(self, key):
+        path = self.disk_path(key)
+        try:
+            size = os.path.getsize(path)
+            os.remove(path)
+        except OSError:
+            return
+        self.lock.acquire(blocking=True)
+        if self.disk_bytes != None:
+            self.disk_bytes -= size
+        self.lock.release()
+
+    @wbetools.js_hide
+    def write_disk(self, key, entry):
+        meta = {
+            "key": key,
+            "headers": entry.headers,
+            "stored_at": entry.stored_at,
+        }
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            path = self.disk_path(key)
+            old_size = 0
+            if os.path.exists(path):
+                old_size = os.path.getsize(path)
+            with open(path + ".tmp", "wb") as f:
+                f.write(json.dumps(meta).encode("utf8") + b"\n")
+                f.write(entry.body)
+            size = os.path.getsize(path + ".tmp")
+            os.replace(path + ".tmp", path)
+        except OSError:
+            return
+        self.lock.acquire(blocking=True)
+        if self.disk_bytes == None:
+            self.disk_bytes = self.measure_disk()
+        else:
+            self.disk_bytes += size - old_size
+        over_budget = self.disk_bytes > HTTP_CACHE_DISK_BYTES
+        self.lock.release()
+        if over_budget: self.trim_disk()
+
+    @wbetools.js_hide
+    def measure_disk(self):
+        total = 0
+        for name in os.listdir(self.directory):
+            total += os.path.getsize(os.path.join(self.directory, name))
+        return total
+
+    @wbetools.js_hide
+    def trim_disk(self):
+        # Like the memory store, drop the least recently used first
+        paths = [os.path.join(self.directory, name)
+            for name in os.listdir(self.directory)]
+        paths.sort(key=os.path.getmtime)
+        for path in paths:
+            self.lock.acquire(blocking=True)
+            done = self.disk_bytes <= HTTP_CACHE_DISK_BYTES
+            self.lock.release()
+            if done: break
+            try:
+                size = os.path.getsize(path)
+                os.remove(path)
+            except OSError:
+                continue
+            self.lock.acquire(blocking=True)
+            self.disk_bytes -= size
+            self.lock.release()
+
+    @wbetools.js_hide
+    def __repr__(self):
+        return ("HttpCache(requests={}, hits={}, revalidations={}, " +
+            "bytes_saved={})").format(self.requests, self.hits,
+            self.revalidations, self.bytes_saved)
+
+# The disk store is only set up when the browser starts, so importing
+# this module never writes to a profile
+HTTP_CACHE = HttpCache(None)
+
+SUBRESOURCE_FETCH_THREADS = 6
+SUBRESOURCE_FETCHES_PER_HOST = 4
+SUBRESOURCE_TIMEOUT_SEC = 30
+# Fetched first to last; "blocking" is for responses someone is waiting on
+SUBRESOURCE_PRIORITIES = \
+    ["blocking", "stylesheet", "script", "visible-image", "image", "iframe"]
+
+class SubresourceLoader:
+    def __init__(self):
+        self.condition = threading.Condition()
+        self.queue = []
+        self.priorities = {}
+        self.in_flight = {}
+        self.pending = {}
+        self.responses = {}
+        self.workers = 0
+        self.fetches = 0
+
+    def prefetch(self, url, referrer, priority="image"):
+        key = str(url)
+        self.condition.acquire(blocking=True)
+        if key in self.pending:
+            self.pending[key] += 1
+            if key in self.priorities and \
+                SUBRESOURCE_PRIORITIES.index(priority) < self.priorities[key]:
+                self.priorities[key] = SUBRESOURCE_PRIORITIES.index(priority)
+        else:
+            self.pending[key] = 1
+            self.queue.append((url, referrer))
+            self.priorities[key] = SUBRESOURCE_PRIORITIES.index(priority)
+            if wbetools.USE_BROWSER_THREAD and \
+                self.workers < SUBRESOURCE_FETCH_THREADS:
+                self.workers += 1
+                threading.Thread(
+                    target=self.run,
+                    name="Network thread",
+                ).start()
+        self.condition.release()
+
+    def reprioritize(self, key, priority):
+        self.condition.acquire(blocking=True)
+        if key in self.priorities:
+            self.priorities[key] = SUBRESOURCE_PRIORITIES.index(priority)
+        self.condition.release()
+
+    def next_request(self):
+        best = None
+        for i, request in enumerate(self.queue):
+            url, referrer = request
+            if self.in_flight.get(url.origin(), 0) >= \
+                SUBRESOURCE_FETCHES_PER_HOST:
+                continue
+            if best == None or self.priorities[str(url)] < \
+                self.priorities[str(self.queue[best][0])]:
+                best = i
+        if best == None: return None
+        url, referrer = self.queue.pop(best)
+        self.priorities.pop(str(url))
+        return url, referrer
+
+    def dequeue(self, key):
+        for i, request in enumerate(self.queue):
+            url, referrer = request
+            if str(url) == key:
+                self.priorities.pop(key)
+                return self.queue.pop(i)
+        return None
+
+    def load(self, url, referrer):
+        # Called with the condition held, which is released while
+        # the request is on the network
+        host = url.origin()
+        self.in_flight[host] = self.in_flight.get(host, 0) + 1
+        self.condition.release()
+        response = None
+        error = None
+        try:
+            response = url.fetch(referrer)
+        except Exception as e:
+            error = e
+        self.condition.acquire(blocking=True)
+        self.in_flight[host] -= 1
+        key = str(url)
+        if key in self.pending and key not in self.responses:
+            self.responses[key] = (response, error, time.time())
+        self.fetches += 1
+        self.condition.notify_all()
+
+    def run(self):
+        self.condition.acquire(blocking=True)
+        while True:
+            request = self.next_request()
+            if not request: break
+            url, referrer = request
+            self.load(url, referrer)
+        # Anything left is waiting on a busy host, whose
+        # fetches will pick it up when they finish
+        self.workers -= 1
+        self.condition.release()
+
+    def take(self, key):
+        self.condition.acquire(blocking=True)
+        if key not in self.pending:
+            self.condition.release()
+            return None
+        if key in self.priorities:
+            self.priorities[key] = SUBRESOURCE_PRIORITIES.index("blocking")
+        while key in self.pending and key not in self.responses:
+            # Without network threads, fetch just this response; the
+            # rest of the queue waits until someone asks for it
+            request = None
+            if self.workers == 0: request = self.dequeue(key)
+            if request:
+                url, referrer = request
+                self.load(url, referrer)
+            else:
+                self.condition.wait()
+        if key not in self.pending:
+            self.condition.release()
+            return None
+        response, error, fetched_at = self.responses[key]
+        if time.time() - fetched_at > SUBRESOURCE_TIMEOUT_SEC:
+            # Nobody used this response in time; it may be stale
+            self.pending.pop(key)
+            self.responses.pop(key)
+            self.condition.release()
+            return None
+        self.pending[key] -= 1
+        if self.pending[key] == 0:
+            self.pending.pop(key)
+            self.responses.pop(key)
+        self.condition.release()
+        if error: raise error
+        return response
+
+    def has_queued(self):
+        self.condition.acquire(blocking=True)
+        queued = len(self.queue) > 0
+        self.condition.release()
+        return queued
+
+    def cancel(self, key):
+        self.condition.acquire(blocking=True)
+        if key in self.pending:
+            self.pending[key] -= 1
+            if self.pending[key] == 0:
+                self.pending.pop(key)
+                if key in self.responses:
+                    self.responses.pop(key)
+                if key in self.priorities:
+                    self.priorities.pop(key)
+                self.queue = [
+                    (url, referrer) for (url, referrer) in self.queue
+                    if str(url) != key
+                ]
+        self.condition.release()
+
+    def reset(self):
+        # Fetches already on the network still finish, but nobody is
+        # waiting for them any more, so their responses are dropped
+        self.condition.acquire(blocking=True)
+        self.queue = []
+        self.priorities = {}
+        self.pending = {}
+        self.responses = {}
+        self.condition.release()
+
+    def request(self, url, referrer):
+        response = self.take(str(url))
+        if response: return response
+        return url.request(referrer)
+
+def subresource_src(tag, attributes):
+    if tag == "script" or tag == "iframe":
+        return attributes.get("src")
+    elif tag == "link" and attributes.get("rel") == "stylesheet":
+        return attributes.get("href")
+    elif tag == "img":
+        return attributes.get("src", "")
+    return None
+
+def subresource_priority(tag):
+    if tag == "link":
+        return "stylesheet"
+    elif tag == "script":
+        return "script"
+    elif tag == "img":
+        return "image"
+    return "iframe"
+
+PRELOAD_TAGS = ["script", "link", "img", "iframe"]
+
+class PreloadScanner:
+    def __init__(self):
+        self.buffer = ""
+
+    def feed(self, text):
+        self.buffer += text
+        found = []
+        start = 0
+        while True:
+            tag_start = self.buffer.find("<", start)
+            if tag_start < 0:
+                start = len(self.buffer)
+                break
+            tag_end = self.buffer.find(">", tag_start)
+            if tag_end < 0:
+                start = tag_start
+                break
+            found_tag = self.scan_tag(self.buffer[tag_start + 1:tag_end])
+            if found_tag: found.append(found_tag)
+            start = tag_end + 1
+        self.buffer = self.buffer[start:]
+        return found
+
+    def scan_tag(self, text):
+        parts = text.split(None, 1)
+        if not parts or parts[0].casefold() not in PRELOAD_TAGS:
+            return None
+        tag, attributes = AttributeParser(text).parse()
+        src = subresource_src(tag, attributes)
+        if src == None: return None
+        return (tag, src)
+
+@wbetools.patch(MeasureTime)
+class MeasureTime:
+    def async_span(self, name, id, start, end, args):
+        if not wbetools.OUTPUT_TRACE: return
+        tid = threading.get_ident()
+        self.lock.acquire(blocking=True)
+        self.file.write(
+            ', { "ph": "b", "cat": "network",' +
+            '"name": ' + json.dumps(name) + ',' +
+            '"id": ' + str(id) + ',' +
+            '"ts": ' + str(start * 1000000) + ',' +
+            '"pid": 1, "tid": ' + str(tid) + ',' +
+            '"args": ' + json.dumps(args) + '}')
+        self.file.write(
+            ', { "ph": "e", "cat": "network",' +
+            '"name": ' + json.dumps(name) + ',' +
+            '"id": ' + str(id) + ',' +
+            '"ts": ' + str(end * 1000000) + ',' +
+            '"pid": 1, "tid": ' + str(tid) + '}')
+        self.file.flush()
+        self.lock.release()
+
+    def counter(self, name, args):
+        if not wbetools.OUTPUT_TRACE: return
+        ts = time.time() * 1000000
+        tid = threading.get_ident()
+        self.lock.acquire(blocking=True)
+        self.file.write(
+            ', { "ph": "C", "cat": "_",' +
+            '"name": ' + json.dumps(name) + ',' +
+            '"ts": ' + str(ts) + ',' +
+            '"pid": 1, "tid": ' + str(tid) + ',' +
+            '"args": ' + json.dumps(args) + '}')
+        self.file.flush()
+        self.lock.release()
+
+class NetworkTrace:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.measure = None
+        self.next_id = 0
+
+    def record(self, timing, status, cache, size):
+        if not self.measure: return
+        self.lock.acquire(blocking=True)
+        self.next_id += 1
+        id = self.next_id
+        self.lock.release()
+        args = {"status": status, "cache": cache, "bytes": size}
+        self.measure.async_span(timing.url, id,
+            timing.start, time.time(), args)
+        for name, start, end in timing.phases:
+            self.measure.async_span(name, id, start, end, {})
+
+NETWORK_TRACE = NetworkTrace()
+
+class RequestTiming:
+    def __init__(self, url):
+        self.url = url
+        self.start = time.time()
+        self.phases = []
+        self.phase = None
+        self.phase_start = 0
+
+    def begin(self, phase):
+        self.end()
+        self.phase = phase
+        self.phase_start = time.time()
+
+    def end(self):
+        if not self.phase: return
+        self.phases.append((self.phase, self.phase_start, time.time()))
+        self.phase = None
+
+    def finish(self, status, cache, size):
+        self.end()
+        NETWORK_TRACE.record(self, status, cache, size)
+
 @wbetools.patch(URL)
 class URL:
-    def request(self, referrer, payload=None):
+    def open_connection(self, timing):
         s = socket.socket(
             family=socket.AF_INET,
             type=socket.SOCK_STREAM,
             proto=socket.IPPROTO_TCP,
         )
-        s.connect((self.host, self.port))
+        timing.begin("dns")
+        address = DNS_CACHE.resolve(self.host, self.port)
+        timing.begin("connect")
+        s.connect(address)
     
         if self.scheme == "https":
-            ctx = ssl.create_default_context()
-            s = ctx.wrap_socket(s, server_hostname=self.host)
-    
+            timing.begin("tls")
+            s = TLS_SESSIONS.wrap(s, self.host, self.port)
+        timing.end()
+        return s
+
+    def request(self, referrer, payload=None):
+        return self.fetch(referrer, payload)
+
+    def fetch(self, referrer, payload=None, receiver=None):
         method = "POST" if payload else "GET"
-        body = "{} {} HTTP/1.0\r\n".format(method, self.path)
-        body += "Host: {}\r\n".format(self.host)
+        cookie = None
         if self.host in COOKIE_JAR:
             cookie, params = COOKIE_JAR[self.host]
             allow_cookie = True
             if referrer and params.get("samesite", "none") == "lax":
                 if method != "GET":
                     allow_cookie = self.host == referrer.host
-            if allow_cookie:
-                body += "Cookie: {}\r\n".format(cookie)
+            if not allow_cookie: cookie = None
+
+        cache_key = str(self)
+        timing = RequestTiming(cache_key)
+        cached = None
+        # The cache is keyed only by URL, so it can't hold responses
+        # that depend on who asked for them
+        credentialed = cookie != None
+        if not payload and not credentialed:
+            cached = HTTP_CACHE.lookup(cache_key)
+            if cached and cached.is_fresh():
+                HTTP_CACHE.served(cached)
+                timing.finish("200", "hit", len(cached.body))
+                # Callers get their own copy of the cached headers
+                headers = cached.headers.copy()
+                if receiver:
+                    receiver.receive_headers(headers)
+                    receiver.receive(cached.body)
+                return headers, cached.body
+
+        body = "{} {} HTTP/1.1\r\n".format(method, self.path)
+        body += "Host: {}\r\n".format(self.host)
+        body += "Accept-Encoding: gzip, deflate\r\n"
+        if cached:
+            body = cached.add_validators(body)
+        if cookie:
+            body += "Cookie: {}\r\n".format(cookie)
         if payload:
             content_length = len(payload.encode("utf8"))
             body += "Content-Length: {}\r\n".format(content_length)
         body += "\r\n" + (payload or "")
-        s.send(body.encode("utf8"))
-    
-        response = s.makefile("b")
-    
-        statusline = response.readline().decode("utf8")
-        version, status, explanation = statusline.split(" ", 2)
-    
+
+        key = (self.scheme, self.host, self.port)
+        # Set inside the loop and the try below, but used after them
+        s = None
+        response = None
+        statusline = ""
+        status = None
+        response_headers = None
+        keep_alive = False
+        revalidated = False
+        while True:
+            # A pooled connection may turn out to be closed, and then
+            # the request is sent again, which isn't safe for a POST
+            s = None
+            if not payload:
+                s = CONNECTION_POOL.checkout(key)
+            reused = s != None
+            if not reused:
+                s = self.open_connection(timing)
+            statusline = ""
+            try:
+                timing.begin("send")
+                s.send(body.encode("utf8"))
+                response = s.makefile("b")
+                timing.begin("wait")
+                statusline = response.readline().decode("utf8")
+            except Exception as e:
+                if not reused:
+                    s.close()
+                    raise e
+            # A pooled connection the server already closed; retry
+            if statusline or not reused: break
+            s.close()
+
+        try:
+            timing.begin("download")
+            version, status, explanation = statusline.split(" ", 2)
+            response_headers = self.read_headers(response)
+
+            if "set-cookie" in response_headers:
+                credentialed = True
+                cookie = response_headers["set-cookie"]
+                params = {}
+                if ";" in cookie:
+                    cookie, rest = cookie.split(";", 1)
+                    for param in rest.split(";"):
+                        if '=' in param:
+                            param, value = param.split("=", 1)
+                        else:
+                            value = "true"
+                        params[param.strip().casefold()] = value.casefold()
+                COOKIE_JAR[self.host] = (cookie, params)
+
+            connection = response_headers.get("connection", "").casefold()
+            if version == "HTTP/1.1":
+                keep_alive = connection != "close"
+            else:
+                keep_alive = connection == "keep-alive"
+
+            transfer_encoding = \
+                response_headers.get("transfer-encoding", "").casefold()
+            content_encoding = \
+                response_headers.get("content-encoding", "").casefold()
+            revalidated = cached and status == "304"
+            if revalidated:
+                response_headers = HTTP_CACHE.revalidated(
+                    cache_key, cached, response_headers)
+            if receiver:
+                receiver.receive_headers(response_headers)
+            decoder = ContentDecoder(content_encoding, receiver)
+            if status in ["204", "304"]:
+                pass
+            elif transfer_encoding == "chunked":
+                read_chunked(response, decoder)
+            elif "content-length" in response_headers:
+                length = int(response_headers["content-length"])
+                read_length(response, length, decoder)
+            else:
+                read_to_close(response, decoder)
+                keep_alive = False
+            body = decoder.finish()
+
+            response.close()
+        except Exception as e:
+            s.close()
+            raise e
+
+        if self.scheme == "https":
+            TLS_SESSIONS.remember(s, self.host, self.port)
+        if keep_alive:
+            CONNECTION_POOL.checkin(key, s)
+        else:
+            s.close()
+
+        if revalidated:
+            timing.finish(status, "revalidated", len(cached.body))
+            if receiver: receiver.receive(cached.body)
+            return response_headers, cached.body
+        if not payload and not credentialed and status == "200":
+            HTTP_CACHE.store(cache_key, response_headers, body)
+        timing.finish(status, "miss", len(body))
+        return response_headers, body
+
+    def read_headers(self, response):
         response_headers = {}
         while True:
             line = response.readline().decode("utf8")
             if line == "\r\n": break
             header, value = line.split(":", 1)
             response_headers[header.casefold()] = value.strip()
-    
-        if "set-cookie" in response_headers:
-            cookie = response_headers["set-cookie"]
-            params = {}
-            if ";" in cookie:
-                cookie, rest = cookie.split(";", 1)
-                for param in rest.split(";"):
-                    if '=' in param:
-                        param, value = param.split("=", 1)
-                    else:
-                        value = "true"
-                    params[param.strip().casefold()] = value.casefold()
-            COOKIE_JAR[self.host] = (cookie, params)
-    
-        assert "transfer-encoding" not in response_headers
-        assert "content-encoding" not in response_headers
-    
-        body = response.read()
-        s.close()
-        return response_headers, body
-      
+        return response_headers
+
+CSS_WORD_PUNCTUATION = ",/#-.%()\"'"
+
+@wbetools.patch(CSSParser)
+class CSSParser:
+    # Same grammar and error recovery as before, but scanning with
+    # str.find where possible and with locals instead of attributes
+    def whitespace(self):
+        s = self.s
+        i = self.i
+        n = len(s)
+        while i < n and s[i].isspace():
+            i += 1
+        self.i = i
+
+    def word(self):
+        s = self.s
+        start = self.i
+        i = start
+        n = len(s)
+        in_quote = False
+        while i < n:
+            cur = s[i]
+            if cur == "'":
+                in_quote = not in_quote
+            if cur.isalnum() or cur in CSS_WORD_PUNCTUATION \
+                or (in_quote and cur == ':'):
+                i += 1
+            else:
+                break
+        self.i = i
+        if not (i > start):
+            raise Exception("Parsing error")
+        return s[start:i]
+
+    def find_any(self, chars):
+        end = len(self.s)
+        for c in chars:
+            j = self.s.find(c, self.i)
+            if j >= 0 and j < end: end = j
+        return end
+
+    def until_chars(self, chars):
+        start = self.i
+        self.i = self.find_any(chars)
+        return self.s[start:self.i]
+
+    def ignore_until(self, chars):
+        self.i = self.find_any(chars)
+        if self.i < len(self.s):
+            return self.s[self.i]
+        return None
+
+    def body(self):
+        # Declarations can't contain ";" or "}", so split them out at
+        # once; a bad one is skipped up to its ";" just as before
+        end = self.find_any(["}"])
+        pairs = {}
+        declarations = self.s[self.i:end].split(";")
+        for i, declaration in enumerate(declarations):
+            # Whitespace is only skipped after a ";"
+            if i == 0 and declaration[:1].isspace(): continue
+            colon = declaration.find(":")
+            prop = declaration[:colon].strip()
+            if colon > 0 and prop.replace("-", "").isalnum():
+                pairs[prop.casefold()] = declaration[colon + 1:].strip()
+            elif declaration.strip():
+                # Anything unusual goes through the full grammar
+                parser = CSSParser(declaration)
+                parser.whitespace()
+                try:
+                    prop, val = parser.pair([";", "}"])
+                    pairs[prop] = val
+                except Exception:
+                    pass
+        self.i = end
+        return pairs
+
 DEFAULT_STYLE_SHEET = CSSParser(open("browser15.css").read()).parse()
 
 def parse_image_rendering(quality):
@@ -627,23 +1582,178 @@ class AttributeParser:
         attributes = {}
         tag = None
 
-        tag = self.word().casefold()
+        tag = sys.intern(self.word().casefold())
         while self.i < len(self.s):
             self.whitespace()
-            key = self.word()
+            key = sys.intern(self.word().casefold())
             if self.literal("="):
                 value = self.word(allow_quotes=True) 
-                attributes[key.casefold()] = value
+                attributes[key] = value
             else:
-                attributes[key.casefold()] = ""
+                attributes[key] = ""
         return (tag, attributes)
 
+# Most nodes are leaves that are never animated, so they share these
+# empty values until they need their own; anything that writes to a
+# node's children, style, or animations must replace these, not
+# mutate them
+NO_CHILDREN = ()
+NO_STYLE = {}
+NO_ANIMATIONS = {}
+
+def append_child(parent, child):
+    if parent.children is NO_CHILDREN:
+        parent.children = []
+    parent.children.append(child)
+
+@wbetools.patch(Element)
+class Element:
+    def __init__(self, tag, attributes, parent):
+        self.tag = tag
+        self.attributes = attributes
+        self.children = NO_CHILDREN
+        self.parent = parent
+
+        self.style = NO_STYLE
+        self.animations = NO_ANIMATIONS
+
+        self.is_focused = False
+        self.layout_object = None
+
+@wbetools.patch(Text)
+class Text:
+    def __init__(self, text, parent):
+        self.text = text
+        self.children = NO_CHILDREN
+        self.parent = parent
+
+        self.style = NO_STYLE
+        self.animations = NO_ANIMATIONS
+
+        self.is_focused = False
+        self.layout_object = None
+
 @wbetools.patch(HTMLParser)
 class HTMLParser:
+    def __init__(self, body, index=None):
+        self.body = body
+        self.index = index
+        self.unfinished = []
+        self.text = ""
+        self.in_tag = False
+        self.mode = "initial"
+
+    def parse(self):
+        self.feed(self.body)
+        return self.finish()
+
+    def parse_fragment(self, context):
+        # Build nodes straight under an existing element, without the
+        # html, head, and body tags a whole document would imply
+        context.children = []
+        self.unfinished = [context]
+        self.update_mode()
+        self.feed(self.body)
+        return self.finish()
+
+    def feed(self, data):
+        # Split out whole text runs and tags at once; growing
+        # self.text a character at a time copies it on every step
+        chunks = data.split("<")
+        for i, chunk in enumerate(chunks):
+            if i > 0:
+                self.in_tag = True
+                if self.text: self.add_text(self.text)
+                self.text = ""
+            pieces = chunk.split(">")
+            self.text += pieces[0]
+            for piece in pieces[1:]:
+                self.in_tag = False
+                self.add_tag(self.text)
+                self.text = piece
+
     def get_attributes(self, text):
         (tag, attributes) = AttributeParser(text).parse()
         return tag, attributes
 
+    def add_text(self, text):
+        if text.isspace(): return
+        self.implicit_tags(None)
+        parent = self.unfinished[-1]
+        node = Text(text, parent)
+        append_child(parent, node)
+
+    def add_tag(self, tag):
+        tag, attributes = self.get_attributes(tag)
+        if tag.startswith("!"): return
+        self.implicit_tags(tag)
+
+        # Nodes join the tree when opened, so a partial parse can be
+        # rendered while the rest of the document streams in
+        if tag.startswith("/"):
+            if len(self.unfinished) == 1: return
+            self.unfinished.pop()
+            self.update_mode()
+        elif tag in self.SELF_CLOSING_TAGS:
+            parent = self.unfinished[-1]
+            node = Element(tag, attributes, parent)
+            append_child(parent, node)
+            if self.index: self.index.add(node, True)
+        else:
+            parent = self.unfinished[-1] if self.unfinished else None
+            node = Element(tag, attributes, parent)
+            if parent: append_child(parent, node)
+            if self.index: self.index.add(node, True)
+            self.unfinished.append(node)
+            self.update_mode()
+
+    def update_mode(self):
+        # Only the bottom two open elements decide which tags are
+        # implied, so there's no need to look at the rest of the stack;
+        # "in element" means no tags are implied
+        depth = len(self.unfinished)
+        if depth == 0:
+            self.mode = "initial"
+        elif depth > 2 or self.unfinished[0].tag != "html":
+            self.mode = "in element"
+        elif depth == 1:
+            self.mode = "before head"
+        elif self.unfinished[1].tag == "head":
+            self.mode = "in head"
+        else:
+            self.mode = "in element"
+
+    def implicit_tags(self, tag):
+        while True:
+            if self.mode == "initial" and tag != "html":
+                self.add_tag("html")
+            elif self.mode == "before head" and \
+                tag not in ["head", "body", "/html"]:
+                if tag in self.HEAD_TAGS:
+                    self.add_tag("head")
+                else:
+                    self.add_tag("body")
+            elif self.mode == "in head" and \
+                tag != "/head" and tag not in self.HEAD_TAGS:
+                self.add_tag("/head")
+            else:
+                break
+
+    def partial_tree(self):
+        if not self.unfinished: return None
+        return self.unfinished[0]
+
+    def finish(self):
+        if not self.in_tag and self.text:
+            self.add_text(self.text)
+        self.text = ""
+        if not self.unfinished:
+            self.implicit_tags(None)
+        root = self.unfinished[0]
+        self.unfinished = []
+        self.mode = "initial"
+        return root
+
 EVENT_DISPATCH_JS = \
     "new window.Node(dukpy.handle)" + \
     ".dispatchEvent(new window.Event(dukpy.type))"
@@ -661,11 +1771,18 @@ class JSContext:
         self.tab = tab
         self.url_origin = url_origin
         self.discarded = False
+        # Set while the page is in the back/forward cache
+        self.frozen = False
+        self.frozen_tasks = []
 
         self.interp = dukpy.JSInterpreter()
         self.interp.export_function("log", print)
         self.interp.export_function("querySelectorAll",
             self.querySelectorAll)
+        self.interp.export_function("getElementById",
+            self.getElementById)
+        self.interp.export_function("getElementsByClassName",
+            self.getElementsByClassName)
         self.interp.export_function("getAttribute",
             self.getAttribute)
         self.interp.export_function("setAttribute",
@@ -724,20 +1841,31 @@ class JSContext:
             type=type, handle=handle)
         return not do_default
 
+    def getElementById(self, id, window_id):
+        frame = self.tab.window_id_to_frame[window_id]
+        self.throw_if_cross_origin(frame)
+        nodes = frame.index.with_id(id)
+        if not nodes: return -1
+        return self.get_handle(nodes[0])
+
+    def getElementsByClassName(self, name, window_id):
+        frame = self.tab.window_id_to_frame[window_id]
+        self.throw_if_cross_origin(frame)
+        nodes = frame.index.with_class(name)
+        return [self.get_handle(node) for node in nodes]
+
     def querySelectorAll(self, selector_text, window_id):
         frame = self.tab.window_id_to_frame[window_id]
         self.throw_if_cross_origin(frame)
         selector = CSSParser(selector_text).selector()
-        nodes = [node for node
-                in tree_to_list(frame.nodes, [])
-                 if selector.matches(node)]
+        nodes = frame.index.select(selector)
         return [self.get_handle(node) for node in nodes]
 
     def setAttribute(self, handle, attr, value, window_id):
         frame = self.tab.window_id_to_frame[window_id]        
         self.throw_if_cross_origin(frame)
         elt = self.handle_to_node[handle]
-        elt.attributes[attr] = value
+        set_attribute(frame, elt, attr, value)
         self.tab.set_needs_render_all_frames()
 
     def parent(self, window_id):
@@ -760,13 +1888,8 @@ class JSContext:
     def innerHTML_set(self, handle, s, window_id):
         frame = self.tab.window_id_to_frame[window_id]        
         self.throw_if_cross_origin(frame)
-        doc = HTMLParser(
-            "<html><body>" + s + "</body></html>").parse()
-        new_nodes = doc.children[0].children
         elt = self.handle_to_node[handle]
-        elt.children = new_nodes
-        for child in elt.children:
-            child.parent = elt
+        replace_children(frame, elt, s)
         frame.set_needs_render()
 
     def style_set(self, handle, s, window_id):
@@ -776,7 +1899,26 @@ class JSContext:
         elt.attributes["style"] = s;
         frame.set_needs_render()
 
+    def freeze(self):
+        self.frozen = True
+
+    def thaw(self):
+        # Callbacks held while frozen run once the page is shown again
+        self.frozen = False
+        for task in self.frozen_tasks:
+            self.tab.task_runner.schedule_task(task)
+        self.frozen_tasks = []
+
+    def discard(self):
+        self.discarded = True
+        self.frozen_tasks = []
+
     def dispatch_settimeout(self, handle, window_id):
+        if self.discarded: return
+        if self.frozen:
+            self.frozen_tasks.append(
+                Task(self.dispatch_settimeout, handle, window_id))
+            return
         self.tab.browser.measure.time('script-settimeout')
         self.interp.evaljs(
             self.wrap(SETTIMEOUT_JS, window_id), handle=handle)
@@ -789,6 +1931,11 @@ class JSContext:
         threading.Timer(time / 1000.0, run_callback).start()
 
     def dispatch_xhr_onload(self, out, handle, window_id):
+        if self.discarded: return
+        if self.frozen:
+            self.frozen_tasks.append(
+                Task(self.dispatch_xhr_onload, out, handle, window_id))
+            return
         code = self.wrap(XHR_ONLOAD_JS, window_id)
         self.tab.browser.measure.time('script-xhr')
         do_default = self.interp.evaljs(code, out=out, handle=handle)
@@ -822,36 +1969,355 @@ class JSContext:
         code = self.wrap("window.__runRAFHandlers()", window_id)
         self.interp.evaljs(code)
 
-@wbetools.patch(style)
-def style(node, rules, frame):
-    old_style = node.style
-
-    node.style = {}
-    for property, default_value in INHERITED_PROPERTIES.items():
-        if node.parent:
-            node.style[property] = node.parent.style[property]
+def rightmost_tag(selector):
+    # Every selector ends in a tag, and only elements with that tag
+    # can match it
+    while not isinstance(selector, TagSelector):
+        if isinstance(selector, DescendantSelector):
+            selector = selector.descendant
         else:
-            node.style[property] = default_value
-    for media, selector, body in rules:
+            selector = selector.base
+    return selector.tag
+
+class RuleIndex:
+    def __init__(self, rules):
+        self.rules = rules
+        self.by_tag = {}
+        for rule in rules:
+            media, selector, body = rule
+            tag = rightmost_tag(selector)
+            if tag not in self.by_tag:
+                self.by_tag[tag] = []
+            self.by_tag[tag].append(rule)
+
+    def candidates(self, node):
+        # Rules keep their cascade order within each tag's list
+        if not isinstance(node, Element): return []
+        return self.by_tag.get(node.tag, [])
+
+    @wbetools.js_hide
+    def __repr__(self):
+        return "RuleIndex(rules={}, tags={})".format(
+            len(self.rules), len(self.by_tag))
+
+class RuleSet:
+    def __init__(self, rules, key=""):
+        # Already in cascade order; a RuleSet is never modified, so
+        # frames can share one and restyling never re-sorts
+        self.rules = rules
+        self.key = key
+        self.index = RuleIndex(rules)
+
+    def merge(self, rules, key=""):
+        # Sort just the new rules, then merge them in, keeping
+        # existing rules first among equal priorities
+        new_rules = sorted(rules, key=cascade_priority)
+        merged = []
+        i = 0
+        j = 0
+        while i < len(self.rules) and j < len(new_rules):
+            if cascade_priority(self.rules[i]) <= \
+                cascade_priority(new_rules[j]):
+                merged.append(self.rules[i])
+                i += 1
+            else:
+                merged.append(new_rules[j])
+                j += 1
+        for rule in self.rules[i:]:
+            merged.append(rule)
+        for rule in new_rules[j:]:
+            merged.append(rule)
+        return RuleSet(merged, key)
+
+    @wbetools.js_hide
+    def __repr__(self):
+        return "RuleSet(rules={})".format(len(self.rules))
+
+DEFAULT_RULES = RuleSet([]).merge(DEFAULT_STYLE_SHEET, "default")
+
+STYLESHEET_CACHE_ENTRIES = 64
+
+class StyleSheetCache:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.entries = {}
+        self.hits = 0
+        self.misses = 0
+        self.parse_time = 0
+        self.time_saved = 0
+
+    def lookup(self, key):
+        self.lock.acquire(blocking=True)
+        entry = self.entries.pop(key, None)
+        if entry:
+            self.entries[key] = entry
+            self.hits += 1
+            self.time_saved += entry[1]
+        self.lock.release()
+        if entry: return entry[0]
+        return None
+
+    def store(self, key, rules, elapsed):
+        self.lock.acquire(blocking=True)
+        self.misses += 1
+        self.parse_time += elapsed
+        self.entries[key] = (rules, elapsed)
+        while len(self.entries) > STYLESHEET_CACHE_ENTRIES:
+            self.entries.pop(next(iter(self.entries)))
+        self.lock.release()
+
+    def parse(self, url, body):
+        # Keyed by contents as well as URL, so a changed stylesheet
+        # is parsed again; the RuleSet is shared, never modified
+        key = str(url) + "#" + hashlib.sha256(body).hexdigest()
+        rules = self.lookup(key)
+        if rules: return rules
+
+        start = time.time()
+        rules = RuleSet([]).merge(
+            CSSParser(body.decode("utf8", "replace")).parse(), key)
+        self.store(key, rules, time.time() - start)
+        return rules
+
+    def merge(self, rules, url, body):
+        # Documents that link the same sheets in the same order share
+        # one merged RuleSet, so its index is only built once
+        sheet = self.parse(url, body)
+        key = rules.key + " " + sheet.key
+        merged = self.lookup(key)
+        if merged: return merged
+
+        start = time.time()
+        merged = rules.merge(sheet.rules, key)
+        self.store(key, merged, time.time() - start)
+        return merged
+
+    @wbetools.js_hide
+    def __repr__(self):
+        return "StyleSheetCache(entries={}, hits={}, misses={})".format(
+            len(self.entries), self.hits, self.misses)
+
+STYLESHEET_CACHE = StyleSheetCache()
+
+class AncestorFilter:
+    def __init__(self):
+        # How many of the elements above the one being styled have
+        # each tag; a descendant selector whose ancestor tags aren't
+        # all here can't match, without walking up the tree
+        self.counts = {}
+        self.checks = 0
+        self.rejects = 0
+
+    def enter(self, node):
+        if not isinstance(node, Element): return
+        self.counts[node.tag] = self.counts.get(node.tag, 0) + 1
+
+    def leave(self, node):
+        if not isinstance(node, Element): return
+        self.counts[node.tag] -= 1
+        if not self.counts[node.tag]:
+            self.counts.pop(node.tag)
+
+    def may_match(self, selector):
+        if not isinstance(selector, DescendantSelector): return True
+        self.checks += 1
+        while isinstance(selector, DescendantSelector):
+            if rightmost_tag(selector.ancestor) not in self.counts:
+                self.rejects += 1
+                return False
+            selector = selector.ancestor
+        return True
+
+    def reject_rate(self):
+        if not self.checks: return 0
+        return self.rejects / self.checks
+
+    @wbetools.js_hide
+    def __repr__(self):
+        return "AncestorFilter(checks={}, rejects={})".format(
+            self.checks, self.rejects)
+
+STYLE_SHARING_CANDIDATES = 16
+
+class StyleSharingCache:
+    def __init__(self):
+        # Recently styled elements, oldest first, with the values
+        # rules and inline styles gave them
+        self.candidates = []
+        self.styled = 0
+        self.shared = 0
+
+    def can_share(self, node, other):
+        if node.tag != other.tag: return False
+        if node.attributes != other.attributes: return False
+        if node.is_focused != other.is_focused: return False
+        if node.parent is other.parent: return True
+        # Cousins match the same selectors if their parents look
+        # alike and share all their ancestors
+        parent = node.parent
+        other_parent = other.parent
+        if not parent or not other_parent: return False
+        if not parent.parent or parent.parent is not other_parent.parent:
+            return False
+        return parent.tag == other_parent.tag and \
+            parent.is_focused == other_parent.is_focused
+
+    def lookup(self, node):
+        self.styled += 1
+        i = len(self.candidates) - 1
+        while i >= 0:
+            other, values = self.candidates[i]
+            if self.can_share(node, other):
+                self.shared += 1
+                return values
+            i -= 1
+        return None
+
+    def add(self, node, values):
+        self.candidates.append((node, values))
+        if len(self.candidates) > STYLE_SHARING_CANDIDATES:
+            self.candidates = self.candidates[1:]
+
+    def reset(self):
+        self.candidates = []
+        self.styled = 0
+        self.shared = 0
+
+    def share_rate(self):
+        if not self.styled: return 0
+        return self.shared / self.styled
+
+    @wbetools.js_hide
+    def __repr__(self):
+        return "StyleSharingCache(styled={}, shared={})".format(
+            self.styled, self.shared)
+
+INLINE_STYLE_ENTRIES = 1024
+
+class InlineStyleCache:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.entries = {}
+        self.hits = 0
+        self.misses = 0
+
+    def parse(self, s):
+        # Parsed declarations are shared by every element with the
+        # same style attribute, so they must not be modified
+        self.lock.acquire(blocking=True)
+        pairs = self.entries.get(s)
+        if pairs != None:
+            self.hits += 1
+        self.lock.release()
+        if pairs != None: return pairs
+
+        pairs = CSSParser(s).body()
+        self.lock.acquire(blocking=True)
+        self.misses += 1
+        self.entries[s] = pairs
+        while len(self.entries) > INLINE_STYLE_ENTRIES:
+            self.entries.pop(next(iter(self.entries)))
+        self.lock.release()
+        return pairs
+
+    @wbetools.js_hide
+    def __repr__(self):
+        return "InlineStyleCache(entries={}, hits={}, misses={})".format(
+            len(self.entries), self.hits, self.misses)
+
+INLINE_STYLES = InlineStyleCache()
+
+def cascaded_values(node, rules, frame):
+    values = {}
+    for media, selector, body in rules.candidates(node):
         if media:
             if (media == "dark") != frame.tab.dark_mode: continue
+        if not frame.ancestors.may_match(selector): continue
         if not selector.matches(node): continue
         for property, value in body.items():
-            node.style[property] = value
+            values[property] = value
     if isinstance(node, Element) and "style" in node.attributes:
-        pairs = CSSParser(node.attributes["style"]).body()
+        pairs = INLINE_STYLES.parse(node.attributes["style"])
         for property, value in pairs.items():
-            node.style[property] = value
-    if node.style["font-size"].endswith("%"):
-        if node.parent:
-            parent_font_size = node.parent.style["font-size"]
+            values[property] = value
+    return values
+
+COMPUTED_STYLE_ENTRIES = 4096
+
+class ComputedStyles:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.records = {}
+        self.hits = 0
+        self.misses = 0
+
+    def intern(self, style):
+        # Nodes with equal styles share one dictionary, so it must
+        # never be modified once interned
+        key = tuple(sorted(style.items()))
+        self.lock.acquire(blocking=True)
+        record = self.records.get(key)
+        if record:
+            self.hits += 1
         else:
-            parent_font_size = INHERITED_PROPERTIES["font-size"]
-        node_pct = float(node.style["font-size"][:-1]) / 100
-        parent_px = float(parent_font_size[:-2])
-        node.style["font-size"] = str(node_pct * parent_px) + "px"
+            self.misses += 1
+            if len(self.records) >= COMPUTED_STYLE_ENTRIES:
+                self.records = {}
+            self.records[key] = style
+            record = style
+        self.lock.release()
+        return record
+
+    @wbetools.js_hide
+    def __repr__(self):
+        return "ComputedStyles(records={}, hits={}, misses={})".format(
+            len(self.records), self.hits, self.misses)
+
+COMPUTED_STYLES = ComputedStyles()
+
+def inherits_only(node):
+    # Every style has the inherited properties, so one with no more
+    # than that has nothing a child wouldn't inherit anyway
+    return len(node.style) == len(INHERITED_PROPERTIES)
+
+def shared_cascaded_values(node, rules, frame):
+    # Only elements are worth sharing; text has no rules to match
+    if not isinstance(node, Element):
+        return cascaded_values(node, rules, frame)
+    values = frame.style_sharing.lookup(node)
+    if values == None:
+        values = cascaded_values(node, rules, frame)
+        frame.style_sharing.add(node, values)
+    return values
+
+@wbetools.patch(style)
+def style(node, rules, frame):
+    old_style = node.style
+
+    values = shared_cascaded_values(node, rules, frame)
+    inherited = not values and not node.animations and \
+        node.parent and inherits_only(node.parent)
+    if inherited:
+        node.style = node.parent.style
+    else:
+        node.style = {}
+        for property, default_value in INHERITED_PROPERTIES.items():
+            if node.parent:
+                node.style[property] = node.parent.style[property]
+            else:
+                node.style[property] = default_value
+        for property, value in values.items():
+            node.style[property] = value
+        if node.style["font-size"].endswith("%"):
+            if node.parent:
+                parent_font_size = node.parent.style["font-size"]
+            else:
+                parent_font_size = INHERITED_PROPERTIES["font-size"]
+            node_pct = float(node.style["font-size"][:-1]) / 100
+            parent_px = float(parent_font_size[:-2])
+            node.style["font-size"] = str(node_pct * parent_px) + "px"
 
-    if old_style:
+    if old_style and old_style is not node.style:
         transitions = diff_styles(old_style, node.style)
         for property, (old_value, new_value, num_frames) \
             in transitions.items():
@@ -859,11 +2325,18 @@ def style(node, rules, frame):
                 frame.set_needs_render()
                 animation = NumericAnimation(
                     old_value, new_value, num_frames)
+                if node.animations is NO_ANIMATIONS:
+                    node.animations = {}
                 node.animations[property] = animation
                 node.style[property] = animation.animate()
+    # Animations write to the style every frame, so it can't be shared
+    if not inherited and not node.animations:
+        node.style = COMPUTED_STYLES.intern(node.style)
 
+    frame.ancestors.enter(node)
     for child in node.children:
         style(child, rules, frame)
+    frame.ancestors.leave(node)
 
 @wbetools.patch(AccessibilityNode)
 class AccessibilityNode:
@@ -1000,6 +2473,257 @@ class FrameAccessibilityNode(AccessibilityNode):
 
 
 BROKEN_IMAGE = skia.Image.open("Broken_Image.png")
+# Stands in for images that are still downloading during partial renders
+LOADING_IMAGE = skia.Surface(
+    BROKEN_IMAGE.width(), BROKEN_IMAGE.height()).makeImageSnapshot()
+
+def index_keys(elt):
+    keys = ["<" + elt.tag]
+    if "id" in elt.attributes:
+        keys.append("#" + elt.attributes["id"])
+    for name in elt.attributes.get("class", "").split():
+        keys.append("." + name)
+    return keys
+
+def document_position(node):
+    position = []
+    while node.parent:
+        position.append(node.parent.children.index(node))
+        node = node.parent
+    position.reverse()
+    return position
+
+class DOMIndex:
+    def __init__(self):
+        self.root = None
+        self.elements = {}
+        # Keys whose elements were not added in document order
+        self.unsorted = {}
+
+    def add(self, elt, in_order):
+        if not elt.parent: self.root = elt
+        for key in index_keys(elt):
+            if key not in self.elements:
+                self.elements[key] = []
+            self.elements[key].append(elt)
+            if not in_order: self.unsorted[key] = True
+
+    def remove(self, elt):
+        for key in index_keys(elt):
+            if elt in self.elements.get(key, []):
+                self.elements[key].remove(elt)
+
+    def add_tree(self, node, in_order):
+        for elt in tree_to_list(node, []):
+            if isinstance(elt, Element): self.add(elt, in_order)
+
+    def remove_tree(self, node):
+        for elt in tree_to_list(node, []):
+            if isinstance(elt, Element): self.remove(elt)
+
+    def is_indexed(self, node):
+        while node.parent:
+            node = node.parent
+        return node == self.root
+
+    def lookup(self, key):
+        if key not in self.elements: return []
+        if key in self.unsorted:
+            self.elements[key] = sorted(
+                self.elements[key], key=document_position)
+            self.unsorted.pop(key)
+        return self.elements[key][:]
+
+    def with_tag(self, tag):
+        return self.lookup("<" + tag)
+
+    def with_id(self, id):
+        return self.lookup("#" + id)
+
+    def with_class(self, name):
+        return self.lookup("." + name)
+
+    def select(self, selector):
+        return [elt for elt in self.with_tag(rightmost_tag(selector))
+                if selector.matches(elt)]
+
+PARSE_CACHE_ENTRIES = 32
+PARSE_CACHE_SEEN = 256
+PARSE_CACHE_MAX_LENGTH = 1024 * 1024
+
+def clone_tree(node, parent):
+    if isinstance(node, Text):
+        return Text(node.text, parent)
+    copy = Element(node.tag, node.attributes.copy(), parent)
+    if node.children:
+        copy.children = [clone_tree(child, copy) for child in node.children]
+    return copy
+
+class ParseCache:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.entries = {}
+        self.seen = {}
+        self.seen_order = []
+        self.hits = 0
+        self.misses = 0
+        self.nodes_cloned = 0
+        self.clone_time = 0
+
+    def lookup(self, key):
+        self.lock.acquire(blocking=True)
+        template = self.entries.pop(key, None)
+        if template:
+            self.entries[key] = template
+            self.hits += 1
+        else:
+            self.misses += 1
+        self.lock.release()
+        return template
+
+    def store(self, key, s, children):
+        # Most strings are only ever parsed once, so a tree is kept
+        # only when its string comes back a second time. The cache
+        # keeps its own copy, so nothing a page does to its nodes can
+        # leak into another page
+        if len(s) > PARSE_CACHE_MAX_LENGTH: return
+        self.lock.acquire(blocking=True)
+        repeated = key in self.seen
+        if not repeated:
+            self.seen[key] = True
+            self.seen_order.append(key)
+            if len(self.seen_order) > PARSE_CACHE_SEEN:
+                self.seen.pop(self.seen_order.pop(0))
+        self.lock.release()
+        if not repeated: return
+
+        template = Element("template", {}, None)
+        template.children = [self.clone(child, template)
+            for child in children]
+        self.lock.acquire(blocking=True)
+        self.entries[key] = template
+        while len(self.entries) > PARSE_CACHE_ENTRIES:
+            self.entries.pop(next(iter(self.entries)))
+        self.lock.release()
+
+    def clone(self, node, parent):
+        start = time.time()
+        copy = clone_tree(node, parent)
+        self.clone_time += time.time() - start
+        self.nodes_cloned += len(tree_to_list(copy, []))
+        return copy
+
+    def parse(self, body, index):
+        key = "document:" + \
+            hashlib.sha256(body.encode("utf8")).hexdigest()
+        template = self.lookup(key)
+        if template:
+            root = self.clone(template.children[0], None)
+        else:
+            root = HTMLParser(body).parse()
+            self.store(key, body, [root])
+        index.add_tree(root, True)
+        return root
+
+    def parse_fragment(self, s, context):
+        # Only an html element implies tags around a fragment; under
+        # any other element, the same string makes the same nodes
+        if context.tag == "html":
+            HTMLParser(s).parse_fragment(context)
+            return
+        key = "fragment:" + hashlib.sha256(s.encode("utf8")).hexdigest()
+        template = self.lookup(key)
+        if template:
+            context.children = [self.clone(child, context)
+                for child in template.children]
+        else:
+            HTMLParser(s).parse_fragment(context)
+            self.store(key, s, context.children)
+
+    def hit_rate(self):
+        if not self.hits + self.misses: return 0
+        return self.hits / (self.hits + self.misses)
+
+    @wbetools.js_hide
+    def __repr__(self):
+        return "ParseCache(entries={}, hits={}, misses={}, cloned={})" \
+            .format(len(self.entries), self.hits, self.misses,
+                self.nodes_cloned)
+
+PARSE_CACHE = ParseCache()
+
+def replace_children(frame, elt, s):
+    indexed = frame.index.is_indexed(elt)
+    for child in elt.children:
+        if indexed: frame.index.remove_tree(child)
+        child.parent = None
+    PARSE_CACHE.parse_fragment(s, elt)
+    if indexed:
+        for child in elt.children:
+            frame.index.add_tree(child, False)
+
+def set_attribute(frame, elt, attr, value):
+    indexed = (attr == "id" or attr == "class") and \
+        frame.index.is_indexed(elt)
+    if indexed: frame.index.remove(elt)
+    elt.attributes[attr] = value
+    if indexed: frame.index.add(elt, False)
+
+class DocumentStream:
+    def __init__(self, frame, url):
+        self.frame = frame
+        self.url = url
+        self.parser = HTMLParser("", frame.index)
+        self.decoder = codecs.getincrementaldecoder("utf8")("replace")
+        self.last_render = time.time()
+        self.scanner = PreloadScanner()
+        self.preloads = {}
+        self.nodes = None
+
+    def receive_headers(self, headers):
+        self.frame.allowed_origins = None
+        if "content-security-policy" in headers:
+            csp = headers["content-security-policy"].split()
+            if len(csp) > 0 and csp[0] == "default-src":
+                self.frame.allowed_origins = csp[1:]
+
+    def feed(self, data):
+        text = self.decoder.decode(data)
+        self.preload(text)
+        self.parser.feed(text)
+
+    def preload(self, text):
+        for tag, src in self.scanner.feed(text):
+            try:
+                preload_url = self.url.resolve(src)
+            except Exception:
+                continue
+            if not self.frame.allowed_request(preload_url): continue
+            key = str(preload_url)
+            if key in self.preloads: continue
+            self.frame.tab.loader.prefetch(
+                preload_url, self.url, subresource_priority(tag))
+            self.preloads[key] = 1
+
+    def feed_all(self, data):
+        # With the whole body in hand, a page parsed before is cloned
+        # from the parse cache instead of being parsed again
+        text = self.decoder.decode(data, True)
+        self.preload(text)
+        self.nodes = PARSE_CACHE.parse(text, self.frame.index)
+
+    def receive(self, data):
+        self.feed(data)
+        if time.time() - self.last_render < REFRESH_RATE_SEC: return
+        nodes = self.parser.partial_tree()
+        if not nodes: return
+        self.frame.render_partial(self.url, nodes)
+        self.last_render = time.time()
+
+    def finish(self):
+        if self.nodes: return self.nodes
+        self.parser.feed(self.decoder.decode(b"", True))
+        return self.parser.finish()
 
 class Frame:
     def __init__(self, tab, parent_frame, frame_element):
@@ -1013,7 +2737,11 @@ class Frame:
         self.scroll = 0
         self.scroll_changed_in_frame = True
         self.needs_focus_scroll = False
+        self.prioritized_scroll = None
         self.nodes = None
+        self.index = DOMIndex()
+        self.ancestors = AncestorFilter()
+        self.style_sharing = StyleSharingCache()
         self.url = None
         self.js = None
         self.loaded = False
@@ -1038,32 +2766,99 @@ class Frame:
         return self.allowed_origins == None or \
             url.origin() in self.allowed_origins
 
+    def prefetch_subresources(self, url, preloaded):
+        needed = {}
+        for tag in PRELOAD_TAGS:
+            for node in self.index.with_tag(tag):
+                src = subresource_src(node.tag, node.attributes)
+                if src == None: continue
+                try:
+                    subresource_url = url.resolve(src)
+                except Exception:
+                    continue
+                if not self.allowed_request(subresource_url): continue
+                key = str(subresource_url)
+                needed[key] = needed.get(key, 0) + 1
+                if needed[key] > preloaded.get(key, 0):
+                    self.tab.loader.prefetch(subresource_url, url,
+                        subresource_priority(node.tag))
+        # The preload scanner can guess wrong, for example inside comments
+        for key in preloaded:
+            if key not in needed:
+                self.tab.loader.cancel(key)
+
     def load(self, url, payload=None):
+        measure = self.tab.browser.measure
+        measure.time('frame-load')
+        try:
+            self.load_document(url, payload)
+            measure.stop('frame-load')
+        except Exception as e:
+            measure.stop('frame-load')
+            raise e
+
+    def load_document(self, url, payload):
         self.loaded = False
         self.zoom = 1
         self.scroll = 0
         self.scroll_changed_in_frame = True
-        headers, body = url.request(self.url, payload)
-        body = body.decode("utf8", "replace")
+        self.index = DOMIndex()
+        # Partial renders run animation frames, which mustn't call the
+        # old page's handlers with the new page's nodes
+        if self.js: self.js.discarded = True
+        self.js = None
+        stream = DocumentStream(self, url)
+        # An iframe's document may already have been prefetched
+        prefetched = None
+        if not payload:
+            prefetched = self.tab.loader.take(str(url))
+        if prefetched:
+            headers, body = prefetched
+            stream.receive_headers(headers)
+            stream.feed_all(body)
+        elif wbetools.USE_BROWSER_THREAD:
+            # Partial renders are only drawn by a separate browser thread
+            headers, body = url.fetch(self.url, payload, stream)
+        else:
+            headers, body = url.request(self.url, payload)
+            stream.receive_headers(headers)
+            stream.feed_all(body)
         self.url = url
+        self.nodes = stream.finish()
 
-        self.allowed_origins = None
-        if "content-security-policy" in headers:
-           csp = headers["content-security-policy"].split()
-           if len(csp) > 0 and csp[0] == "default-src":
-               self.allowed_origins = csp[1:]
-
-        self.nodes = HTMLParser(body).parse()
-
-        if self.js: self.js.discarded = True
         self.js = self.tab.get_js(url)
         self.js.add_window(self)
 
+        measure = self.tab.browser.measure
+        measure.time('frame-subresources')
+        try:
+            self.load_subresources(url, stream.preloads)
+            measure.stop('frame-subresources')
+        except Exception as e:
+            measure.stop('frame-subresources')
+            raise e
+
+        iframes = [node
+                   for node in self.index.with_tag("iframe")
+                   if "src" in node.attributes]
+        for iframe in iframes:
+            document_url = url.resolve(iframe.attributes["src"])
+            if not self.allowed_request(document_url):
+                print("Blocked iframe", document_url, "due to CSP")
+                iframe.frame = None
+                continue
+            iframe.frame = Frame(self.tab, self, iframe)
+            task = Task(iframe.frame.load, document_url)
+            self.tab.task_runner.schedule_task(task)
+
+        self.set_needs_render()
+        self.loaded = True
+
+    def load_subresources(self, url, preloads):
+        self.prefetch_subresources(url, preloads)
         scripts = [node.attributes["src"] for node
-                   in tree_to_list(self.nodes, [])
-                   if isinstance(node, Element)
-                   and node.tag == "script"
-                   and "src" in node.attributes]
+                   in self.index.with_tag("script")
+                   if "src" in node.attributes]
         for script in scripts:
             script_url = url.resolve(script)
             if not self.allowed_request(script_url):
@@ -1071,20 +2866,18 @@ class Frame:
                 continue
 
             try:
-                header, body = script_url.request(url)
+                header, body = self.tab.loader.request(script_url, url)
+                body = body.decode("utf8", "replace")
+                task = Task(self.js.run, script_url, body,
+                    self.window_id)
+                self.tab.task_runner.schedule_task(task)
             except:
                 continue
-            body = body.decode("utf8", "replace")
-            task = Task(self.js.run, script_url, body,
-                self.window_id)
-            self.tab.task_runner.schedule_task(task)
 
-        self.rules = DEFAULT_STYLE_SHEET.copy()
+        self.rules = DEFAULT_RULES
         links = [node.attributes["href"]
-                 for node in tree_to_list(self.nodes, [])
-                 if isinstance(node, Element)
-                 and node.tag == "link"
-                 and node.attributes.get("rel") == "stylesheet"
+                 for node in self.index.with_tag("link")
+                 if node.attributes.get("rel") == "stylesheet"
                  and "href" in node.attributes]
         for link in links:  
             style_url = url.resolve(link)
@@ -1092,22 +2885,22 @@ class Frame:
                 print("Blocked style", link, "due to CSP")
                 continue
             try:
-                header, body = style_url.request(url)
+                header, body = self.tab.loader.request(style_url, url)
+                self.rules = STYLESHEET_CACHE.merge(
+                    self.rules, style_url, body)
             except:
                 continue
-            self.rules.extend(CSSParser(body.decode("utf8", "replace")).parse())
+        self.tab.browser.measure.counter("stylesheet-cache",
+            {"parse-time-saved": STYLESHEET_CACHE.time_saved})
 
-        images = [node
-            for node in tree_to_list(self.nodes, [])
-            if isinstance(node, Element)
-            and node.tag == "img"]
+        images = self.index.with_tag("img")
         for img in images:
             try:
                 src = img.attributes.get("src", "")
                 image_url = url.resolve(src)
                 assert self.allowed_request(image_url), \
                     "Blocked load of " + str(image_url) + " due to CSP"
-                header, body = image_url.request(url)
+                header, body = self.tab.loader.request(image_url, url)
                 img.encoded_data = body
                 data = skia.Data.MakeWithoutCopy(body)
                 img.image = skia.Image.MakeFromEncoded(data)
@@ -1119,23 +2912,41 @@ class Frame:
                     "crashed", e)
                 img.image = BROKEN_IMAGE
 
-        iframes = [node
-                   for node in tree_to_list(self.nodes, [])
-                   if isinstance(node, Element)
-                   and node.tag == "iframe"
-                   and "src" in node.attributes]
-        for iframe in iframes:
-            document_url = url.resolve(iframe.attributes["src"])
-            if not self.allowed_request(document_url):
-                print("Blocked iframe", document_url, "due to CSP")
-                iframe.frame = None
-                continue
-            iframe.frame = Frame(self.tab, self, iframe)
-            task = Task(iframe.frame.load, document_url)
-            self.tab.task_runner.schedule_task(task)
-
+    def render_partial(self, url, nodes):
+        self.url = url
+        self.nodes = nodes
+        self.rules = DEFAULT_RULES
+        for node in tree_to_list(self.nodes, []):
+            if isinstance(node, Element) and node.tag == "img":
+                node.image = LOADING_IMAGE
+            elif isinstance(node, Element) and node.tag == "iframe":
+                # Its frame isn't created until the document is loaded
+                node.frame = None
         self.set_needs_render()
         self.loaded = True
+        self.tab.run_animation_frame(self.tab.root_frame.scroll)
+        self.loaded = False
+        self.prioritize_visible_images()
+        # The complete document is styled from scratch once it loads
+        for node in tree_to_list(self.nodes, []):
+            node.style = None
+
+    def prioritize_visible_images(self):
+        self.prioritized_scroll = self.scroll
+        top = self.scroll
+        bottom = self.scroll + self.frame_height
+        for obj in tree_to_list(self.document, []):
+            if not isinstance(obj, ImageLayout): continue
+            try:
+                image_url = self.url.resolve(
+                    obj.node.attributes.get("src", ""))
+            except Exception:
+                continue
+            if obj.y < bottom and obj.y + obj.height > top:
+                priority = "visible-image"
+            else:
+                priority = "image"
+            self.tab.loader.reprioritize(str(image_url), priority)
 
     def render(self):
         if self.needs_style:
@@ -1143,9 +2954,10 @@ class Frame:
                 INHERITED_PROPERTIES["color"] = "white"
             else:
                 INHERITED_PROPERTIES["color"] = "black"
-            style(self.nodes,
-                  sorted(self.rules,
-                         key=cascade_priority), self)
+            self.style_sharing.reset()
+            style(self.nodes, self.rules.index, self)
+            self.tab.browser.measure.counter("style-sharing",
+                {"share-rate": self.style_sharing.share_rate()})
             self.needs_layout = True
             self.needs_style = False
 
@@ -1303,6 +3115,96 @@ class CommitData:
         self.accessibility_tree = accessibility_tree
         self.focus = focus
 
+BFCACHE_ENTRIES = 3
+BFCACHE_MEMORY_BUDGET = 64 * 1024 * 1024
+# A rough cost, in bytes, of a DOM node with its style and layout objects
+BFCACHE_BYTES_PER_NODE = 2048
+
+class PageSnapshot:
+    def __init__(self, tab):
+        self.url = tab.root_frame.url
+        self.root_frame = tab.root_frame
+        self.window_id_to_frame = tab.window_id_to_frame
+        self.origin_to_js = tab.origin_to_js
+        self.focus = tab.focus
+        self.focused_frame = tab.focused_frame
+        self.zoom = tab.zoom
+        self.dark_mode = tab.dark_mode
+        self.size = 0
+        for id, frame in self.window_id_to_frame.items():
+            # Iframes that are still loading, or failed to, have no tree
+            if not frame.loaded or frame.nodes is None: continue
+            for node in tree_to_list(frame.nodes, []):
+                self.size += BFCACHE_BYTES_PER_NODE
+                if isinstance(node, Text):
+                    self.size += len(node.text)
+                elif node.tag == "img":
+                    # Loaded frames give every image a decoded, loading,
+                    # or broken image
+                    self.size += \
+                        node.image.width() * node.image.height() * 4
+
+    def freeze(self):
+        for id, frame in self.window_id_to_frame.items():
+            if frame.js: frame.js.freeze()
+
+    def thaw(self):
+        for id, frame in self.window_id_to_frame.items():
+            if frame.js: frame.js.thaw()
+
+    def discard(self):
+        for id, frame in self.window_id_to_frame.items():
+            if frame.js: frame.js.discard()
+
+class BackForwardCache:
+    def __init__(self):
+        self.entries = {}
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def store(self, index, snapshot):
+        self.evict(index)
+        if snapshot.size > BFCACHE_MEMORY_BUDGET: return
+        snapshot.freeze()
+        self.entries[index] = snapshot
+        self.size += snapshot.size
+        while len(self.entries) > BFCACHE_ENTRIES or \
+            self.size > BFCACHE_MEMORY_BUDGET:
+            oldest = next(iter(self.entries))
+            self.evict(oldest)
+            self.evictions += 1
+
+    def take(self, index, url, zoom, dark_mode):
+        snapshot = self.entries.pop(index, None)
+        if snapshot:
+            self.size -= snapshot.size
+        # A page styled and laid out for other settings isn't reusable
+        if not snapshot or str(snapshot.url) != str(url) or \
+            snapshot.zoom != zoom or snapshot.dark_mode != dark_mode:
+            self.misses += 1
+            if snapshot: snapshot.discard()
+            return None
+        self.hits += 1
+        return snapshot
+
+    def evict(self, index):
+        snapshot = self.entries.pop(index, None)
+        if snapshot:
+            self.size -= snapshot.size
+            snapshot.discard()
+
+    def forget_after(self, index):
+        # Entries past the current one can no longer be navigated to
+        for i in list(self.entries):
+            if i >= index: self.evict(i)
+
+    @wbetools.js_hide
+    def __repr__(self):
+        return "BackForwardCache(entries={}, size={}, hits={}, misses={})" \
+            .format(len(self.entries), self.size, self.hits, self.misses)
+
 @wbetools.patch(Tab)
 class Tab:
     def __init__(self, browser, tab_height):
@@ -1322,6 +3224,9 @@ class Tab:
         self.has_spoken_document = False
         self.accessibility_focus = None
         self.loaded = False
+        # Shared by the tab's frames, so an iframe document that its
+        # parent prefetched is taken when the iframe loads
+        self.loader = SubresourceLoader()
 
         self.browser = browser
         if wbetools.USE_BROWSER_THREAD:
@@ -1335,17 +3240,32 @@ class Tab:
 
         self.window_id_to_frame = {}
         self.origin_to_js = {}
+        self.bfcache = BackForwardCache()
 
     def load(self, url, payload=None):
         self.loaded = False
+        if self.root_frame and self.root_frame.loaded:
+            self.bfcache.store(len(self.history) - 1, PageSnapshot(self))
+        self.discard_scripts()
+        self.bfcache.forget_after(len(self.history))
         self.history.append(url)
         self.task_runner.clear_pending_tasks()
+        self.loader.reset()
+        self.window_id_to_frame = {}
+        self.origin_to_js = {}
+        self.focus = None
+        self.focused_frame = None
         self.root_frame = Frame(self, None, None)
-        self.root_frame.load(url, payload)
         self.root_frame.frame_width = WIDTH
         self.root_frame.frame_height = self.tab_height
+        self.root_frame.load(url, payload)
         self.loaded = True
 
+    def discard_scripts(self):
+        # Only a page frozen in the back/forward cache can run again
+        for id, frame in self.window_id_to_frame.items():
+            if frame.js and not frame.js.frozen: frame.js.discard()
+
     def get_js(self, url):
         origin = url.origin()
         if wbetools.FORCE_CROSS_ORIGIN_IFRAMES:
@@ -1370,6 +3290,8 @@ class Tab:
         for (window_id, frame) in self.window_id_to_frame.items():
             if not frame.loaded:
                 continue
+            # Frames still streaming in have no scripts yet
+            if not frame.js: continue
 
             self.browser.measure.time('script-runRAFHandlers')
             frame.js.dispatch_RAF(frame.window_id)
@@ -1396,6 +3318,13 @@ class Tab:
             self.focused_frame.scroll_to(self.focus)
             self.focused_frame.needs_focus_scroll = False
 
+        # Images scrolled into view jump ahead of those still off screen
+        if self.loader.has_queued():
+            for (window_id, frame) in self.window_id_to_frame.items():
+                if frame.loaded and \
+                    frame.scroll != frame.prioritized_scroll:
+                    frame.prioritize_visible_images()
+
         for (window_id, frame) in self.window_id_to_frame.items():
             if frame == self.root_frame: continue
             if frame.scroll_changed_in_frame:
@@ -1492,7 +3421,31 @@ class Tab:
         if len(self.history) > 1:
             self.history.pop()
             back = self.history.pop()
-            self.load(back)
+            # Without forward navigation, the current page is discarded
+            self.discard_scripts()
+            self.root_frame = None
+            snapshot = self.bfcache.take(len(self.history), back,
+                self.zoom, self.dark_mode)
+            if snapshot:
+                self.restore_snapshot(back, snapshot)
+            else:
+                self.load(back)
+
+    def restore_snapshot(self, url, snapshot):
+        self.history.append(url)
+        self.task_runner.clear_pending_tasks()
+        self.loader.reset()
+        self.root_frame = snapshot.root_frame
+        self.window_id_to_frame = snapshot.window_id_to_frame
+        self.origin_to_js = snapshot.origin_to_js
+        self.focus = snapshot.focus
+        self.focused_frame = snapshot.focused_frame
+        # The DOM and layout tree are intact, so only paint again
+        self.root_frame.scroll_changed_in_frame = True
+        self.needs_accessibility = True
+        self.set_needs_paint()
+        self.loaded = True
+        snapshot.thaw()
 
     def set_dark_mode(self, val):
         self.dark_mode = val
@@ -1567,6 +3520,7 @@ class Browser:
         self.active_tab_scroll = 0
 
         self.measure = MeasureTime()
+        NETWORK_TRACE.measure = self.measure
         threading.current_thread().name = "Browser thread"
 
         if sdl2.SDL_BYTEORDER == sdl2.SDL_BIG_ENDIAN:
@@ -1662,6 +3616,7 @@ class Browser:
 
 if __name__ == "__main__":
     wbetools.parse_flags()
+    HTTP_CACHE.directory = http_cache_directory(wbetools.PROFILE_DIRECTORY)
     sdl2.SDL_Init(sdl2.SDL_INIT_EVENTS)
     browser = Browser()
     browser.new_tab(URL(sys.argv[1]))
@@ -14,7 +14,12 @@ import threading
 import socket
 import ssl
 import dukpy
+import codecs
+import hashlib
+import json
+import os
 import time
+import zlib
 import wbetools
 
 from lab2 import WIDTH, HEIGHT, HSTEP, VSTEP, SCROLL_STEP
@@ -27,7 +32,7 @@ from lab8 import INPUT_WIDTH_PX
 from lab10 import COOKIE_JAR
 from lab11 import FONTS, NAMED_COLORS, get_font, linespace
 from lab11 import parse_color, parse_blend_mode
-from lab12 import MeasureTime, REFRESH_RATE_SEC, SETTIMEOUT_JS, XHR_ONLOAD_JS
+from lab12 import REFRESH_RATE_SEC, SETTIMEOUT_JS, XHR_ONLOAD_JS
 from lab12 import Task, TaskRunner, SingleThreadedTaskRunner
 from lab13 import diff_styles, parse_transition, add_parent_pointers
 from lab13 import local_to_absolute, absolute_bounds_for_obj, absolute_to_local
@@ -45,9 +50,30 @@ from lab15 import URL, HTMLParser, AttributeParser, DrawImage, \
     DocumentLayout, BlockLayout, \
     EmbedLayout, InputLayout, LineLayout, TextLayout, ImageLayout, \
     IframeLayout, JSContext, AccessibilityNode, FrameAccessibilityNode, Frame, Tab, \
-    CommitData, Browser, BROKEN_IMAGE, font, \
+    CommitData, Browser, BROKEN_IMAGE, LOADING_IMAGE, font, \
+    NO_CHILDREN, NO_ANIMATIONS, append_child, \
     IFRAME_WIDTH_PX, IFRAME_HEIGHT_PX, parse_image_rendering, DEFAULT_STYLE_SHEET, \
-    EVENT_DISPATCH_JS, RUNTIME_JS, POST_MESSAGE_DISPATCH_JS
+    EVENT_DISPATCH_JS, RUNTIME_JS, POST_MESSAGE_DISPATCH_JS, \
+    ConnectionPool, CONNECTION_POOL, MAX_IDLE_CONNECTIONS_PER_HOST, \
+    CONNECTION_IDLE_TIMEOUT_SEC, DNS_CACHE_TTL_SEC, DNSCache, DNS_CACHE, \
+    TLSSessionCache, TLS_SESSIONS, BODY_BLOCK_SIZE, ContentDecoder, \
+    MeasureTime, NetworkTrace, NETWORK_TRACE, RequestTiming, \
+    read_length, read_chunked, read_to_close, parse_cache_control, \
+    CacheEntry, HTTP_CACHE_MEMORY_ENTRIES, HTTP_CACHE_DISK_BYTES, \
+    http_cache_directory, HttpCache, HTTP_CACHE, SUBRESOURCE_FETCH_THREADS, \
+    SUBRESOURCE_FETCHES_PER_HOST, SUBRESOURCE_TIMEOUT_SEC, \
+    SUBRESOURCE_PRIORITIES, SubresourceLoader, \
+    subresource_src, subresource_priority, PRELOAD_TAGS, PreloadScanner, DocumentStream, \
+    index_keys, document_position, DOMIndex, replace_children, set_attribute, \
+    PARSE_CACHE_ENTRIES, PARSE_CACHE_SEEN, PARSE_CACHE_MAX_LENGTH, \
+    clone_tree, ParseCache, PARSE_CACHE, rightmost_tag, RuleIndex, RuleSet, DEFAULT_RULES, AncestorFilter, \
+    STYLE_SHARING_CANDIDATES, StyleSharingCache, cascaded_values, \
+    shared_cascaded_values, COMPUTED_STYLE_ENTRIES, ComputedStyles, \
+    COMPUTED_STYLES, inherits_only, STYLESHEET_CACHE_ENTRIES, \
+    StyleSheetCache, STYLESHEET_CACHE, CSS_WORD_PUNCTUATION, \
+    INLINE_STYLE_ENTRIES, InlineStyleCache, INLINE_STYLES, \
+    BFCACHE_ENTRIES, BFCACHE_MEMORY_BUDGET, BFCACHE_BYTES_PER_NODE, \
+    PageSnapshot, BackForwardCache
 
 
 class ProtectedField:
@@ -243,11 +269,12 @@ class Element:
     def __init__(self, tag, attributes, parent):
         self.tag = tag
         self.attributes = attributes
-        self.children = []
+        self.children = NO_CHILDREN
         self.parent = parent
 
         self.style = None
-        self.animations = {}
+        self.animations = NO_ANIMATIONS
+        self.has_dirty_descendants = True
 
         self.is_focused = False
         self.layout_object = None
@@ -256,11 +283,12 @@ class Element:
 class Text:
     def __init__(self, text, parent):
         self.text = text
-        self.children = []
+        self.children = NO_CHILDREN
         self.parent = parent
 
         self.style = None
-        self.animations = {}
+        self.animations = NO_ANIMATIONS
+        self.has_dirty_descendants = True
 
         self.is_focused = False
         self.layout_object = None
@@ -947,8 +975,15 @@ def init_style(node):
 
 @wbetools.patch(style)
 def style(node, rules, frame):
+    # Clean subtrees, including the node's clean siblings, are
+    # skipped before their own styles are looked at
+    if not node.has_dirty_descendants: return
     if not node.style:
         init_style(node)
+        # Style fields flag their own node, so a DOM node's
+        # has_dirty_descendants also covers its own style
+        for field in node.style.values():
+            field.parent = node
     needs_style = any([field.dirty for field in node.style.values()])
     if needs_style:
         old_style = dict([
@@ -964,16 +999,9 @@ def style(node, rules, frame):
                 new_style[property] = parent_value
             else:
                 new_style[property] = default_value
-        for media, selector, body in rules:
-            if media:
-                if (media == 'dark') != frame.tab.dark_mode: continue
-            if not selector.matches(node): continue
-            for property, value in body.items():
-                new_style[property] = value
-        if isinstance(node, Element) and 'style' in node.attributes:
-            pairs = CSSParser(node.attributes['style']).body()
-            for property, value in pairs.items():
-                new_style[property] = value
+        values = shared_cascaded_values(node, rules, frame)
+        for property, value in values.items():
+            new_style[property] = value
         if new_style["font-size"].endswith("%"):
             if node.parent:
                 parent_field = node.parent.style["font-size"]
@@ -984,6 +1012,9 @@ def style(node, rules, frame):
             node_pct = float(new_style["font-size"][:-1]) / 100
             parent_px = float(parent_font_size[:-2])
             new_style["font-size"] = str(node_pct * parent_px) + "px"
+        # Equal values in different nodes then share one string
+        for property, value in new_style.items():
+            if value: new_style[property] = sys.intern(value)
         if old_style:
             transitions = diff_styles(old_style, new_style)
             for property, (old_value, new_value, num_frames) in \
@@ -992,32 +1023,42 @@ def style(node, rules, frame):
                     frame.set_needs_render()
                     animation = NumericAnimation(
                         old_value, new_value, num_frames)
+                    if node.animations is NO_ANIMATIONS:
+                        node.animations = {}
                     node.animations[property] = animation
                     new_style[property] = animation.animate()
         for property, field in node.style.items():
             field.set(new_style[property])
 
+    frame.ancestors.enter(node)
     for child in node.children:
         style(child, rules, frame)
+    frame.ancestors.leave(node)
+    node.has_dirty_descendants = False
 
 def dirty_style(node):
     for property, value in node.style.items():
         value.mark()
 
+def dirty_style_descendants(node):
+    while node and not node.has_dirty_descendants:
+        node.has_dirty_descendants = True
+        node = node.parent
+
 @wbetools.patch(JSContext)
 class JSContext:
     def innerHTML_set(self, handle, s, window_id):
         frame = self.tab.window_id_to_frame[window_id]        
         self.throw_if_cross_origin(frame)
-        doc = HTMLParser(
-            "<html><body>" + s + "</body></html>").parse()
-        new_nodes = doc.children[0].children
         elt = self.handle_to_node[handle]
-        elt.children = new_nodes
-        for child in elt.children:
-            child.parent = elt
-        obj = elt.layout_object
-        if obj:
+        replace_children(frame, elt, s)
+        dirty_style_descendants(elt)
+        # Inline elements have no layout object of their own; relayout
+        # the block that holds their text, which points at the old children
+        node = elt
+        while node and not node.layout_object: node = node.parent
+        if node:
+            obj = node.layout_object
             while not isinstance(obj, BlockLayout):
                 obj = obj.parent
             obj.children.mark()
@@ -1027,7 +1068,7 @@ class JSContext:
         frame = self.tab.window_id_to_frame[window_id]        
         self.throw_if_cross_origin(frame)
         elt = self.handle_to_node[handle]
-        elt.attributes[attr] = value
+        set_attribute(frame, elt, attr, value)
         obj = elt.layout_object
         if isinstance(obj, IframeLayout) or \
            isinstance(obj, ImageLayout):
@@ -1065,103 +1106,54 @@ def paint_tree(layout_object, display_list):
 @wbetools.patch(Frame)
 class Frame:
     def load(self, url, payload=None):
-        self.loaded = False
-        self.zoom = 1
-        self.scroll = 0
-        self.scroll_changed_in_frame = True
-        headers, body = url.request(self.url, payload)
-        body = body.decode("utf8", "replace")
+        measure = self.tab.browser.measure
+        measure.time('frame-load')
+        try:
+            self.load_document(url, payload)
+            self.document = DocumentLayout(self.nodes, self)
+            measure.stop('frame-load')
+        except Exception as e:
+            measure.stop('frame-load')
+            raise e
+
+    def render_partial(self, url, nodes):
         self.url = url
-
-        self.allowed_origins = None
-        if "content-security-policy" in headers:
-           csp = headers["content-security-policy"].split()
-           if len(csp) > 0 and csp[0] == "default-src":
-               self.allowed_origins = csp[1:]
-
-        self.nodes = HTMLParser(body).parse()
-
-        if self.js: self.js.discarded = True
-        self.js = self.tab.get_js(url)
-        self.js.add_window(self)
-
-        scripts = [node.attributes["src"] for node
-                   in tree_to_list(self.nodes, [])
-                   if isinstance(node, Element)
-                   and node.tag == "script"
-                   and "src" in node.attributes]
-        for script in scripts:
-            script_url = url.resolve(script)
-            if not self.allowed_request(script_url):
-                print("Blocked script", script, "due to CSP")
-                continue
-
-            try:
-                header, body = script_url.request(url)
-            except:
-                continue
-            body = body.decode("utf8", "replace")
-            task = Task(self.js.run, script_url, body,
-                self.window_id)
-            self.tab.task_runner.schedule_task(task)
-
-        self.rules = DEFAULT_STYLE_SHEET.copy()
-        links = [node.attributes["href"]
-                 for node in tree_to_list(self.nodes, [])
-                 if isinstance(node, Element)
-                 and node.tag == "link"
-                 and node.attributes.get("rel") == "stylesheet"
-                 and "href" in node.attributes]
-        for link in links:  
-            style_url = url.resolve(link)
-            if not self.allowed_request(style_url):
-                print("Blocked style", link, "due to CSP")
-                continue
-            try:
-                header, body = style_url.request(url)
-            except:
-                continue
-            self.rules.extend(CSSParser(body.decode("utf8", "replace")).parse())
-
-        images = [node
-            for node in tree_to_list(self.nodes, [])
-            if isinstance(node, Element)
-            and node.tag == "img"]
-        for img in images:
-            try:
-                src = img.attributes.get("src", "")
-                image_url = url.resolve(src)
-                assert self.allowed_request(image_url), \
-                    "Blocked load of " + str(image_url) + " due to CSP"
-                header, body = image_url.request(url)
-                img.encoded_data = body
-                data = skia.Data.MakeWithoutCopy(body)
-                img.image = skia.Image.MakeFromEncoded(data)
-                assert img.image, \
-                    "Failed to recognize image format for " + str(image_url)
-            except Exception as e:
-                print("Image", img.attributes.get("src", ""),
-                    "crashed", e)
-                img.image = BROKEN_IMAGE
-
-        iframes = [node
-                   for node in tree_to_list(self.nodes, [])
-                   if isinstance(node, Element)
-                   and node.tag == "iframe"
-                   and "src" in node.attributes]
-        for iframe in iframes:
-            document_url = url.resolve(iframe.attributes["src"])
-            if not self.allowed_request(document_url):
-                print("Blocked iframe", document_url, "due to CSP")
-                iframe.frame = None
-                continue
-            iframe.frame = Frame(self.tab, self, iframe)
-            task = Task(iframe.frame.load, document_url)
-            self.tab.task_runner.schedule_task(task)
-
+        self.nodes = nodes
+        self.rules = DEFAULT_RULES
+        for node in tree_to_list(self.nodes, []):
+            if isinstance(node, Element) and node.tag == "img":
+                node.image = LOADING_IMAGE
+            elif isinstance(node, Element) and node.tag == "iframe":
+                # Its frame isn't created until the document is loaded
+                node.frame = None
         self.document = DocumentLayout(self.nodes, self)
         self.set_needs_render()
         self.loaded = True
+        self.tab.run_animation_frame(self.tab.root_frame.scroll)
+        self.loaded = False
+        self.prioritize_visible_images()
+        # The complete document is styled from scratch once it loads
+        for node in tree_to_list(self.nodes, []):
+            node.style = None
+            node.has_dirty_descendants = True
+
+    def prioritize_visible_images(self):
+        self.prioritized_scroll = self.scroll
+        top = self.scroll
+        bottom = self.scroll + self.frame_height
+        for obj in tree_to_list(self.document, []):
+            if not isinstance(obj, ImageLayout): continue
+            try:
+                image_url = self.url.resolve(
+                    obj.node.attributes.get("src", ""))
+            except Exception:
+                continue
+            y = obj.y.get()
+            if y < bottom and y + obj.height.get() > top:
+                priority = "visible-image"
+            else:
+                priority = "image"
+            self.tab.loader.reprioritize(str(image_url), priority)
 
     def render(self):
         if self.needs_style:
@@ -1169,9 +1161,10 @@ class Frame:
                 INHERITED_PROPERTIES["color"] = "white"
             else:
                 INHERITED_PROPERTIES["color"] = "black"
-            style(self.nodes,
-                  sorted(self.rules,
-                         key=cascade_priority), self)
+            self.style_sharing.reset()
+            style(self.nodes, self.rules.index, self)
+            self.tab.browser.measure.counter("style-sharing",
+                {"share-rate": self.style_sharing.share_rate()})
             self.needs_layout = True
             self.needs_style = False
 
@@ -1204,7 +1197,7 @@ class Frame:
                 last_text = text_nodes[-1]
             else:
                 last_text = Text("", self.tab.focus)
-                self.tab.focus.children.append(last_text)
+                append_child(self.tab.focus, last_text)
             last_text.text += char
             obj = self.tab.focus.layout_object
             while not isinstance(obj, BlockLayout):
@@ -1308,6 +1301,8 @@ class Tab:
         for (window_id, frame) in self.window_id_to_frame.items():
             if not frame.loaded:
                 continue
+            # Frames still streaming in have no scripts yet
+            if not frame.js: continue
 
             self.browser.measure.time('script-runRAFHandlers')
             frame.js.dispatch_RAF(frame.window_id)
@@ -1334,6 +1329,13 @@ class Tab:
             self.focused_frame.scroll_to(self.focus)
             self.focused_frame.needs_focus_scroll = False
 
+        # Images scrolled into view jump ahead of those still off screen
+        if self.loader.has_queued():
+            for (window_id, frame) in self.window_id_to_frame.items():
+                if frame.loaded and \
+                    frame.scroll != frame.prioritized_scroll:
+                    frame.prioritize_visible_images()
+
         for (window_id, frame) in self.window_id_to_frame.items():
             if frame == self.root_frame: continue
             if frame.scroll_changed_in_frame:
@@ -1409,6 +1411,7 @@ class AccessibilityNode:
 
 if __name__ == "__main__":
     wbetools.parse_flags()
+    HTTP_CACHE.directory = http_cache_directory(wbetools.PROFILE_DIRECTORY)
     sdl2.SDL_Init(sdl2.SDL_INIT_EVENTS)
     browser = Browser()
     browser.new_tab(URL(sys.argv[1]))
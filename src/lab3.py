@@ -47,6 +47,35 @@ def lex(body):
         out.append(Text(buffer))
     return out
 
+@wbetools.js_hide
+def lex_stream(blocks):
+    # Yields the same tokens as lex without holding the whole body. A
+    # text run that spans blocks is cut between words, which Layout
+    # treats the same as one run
+    buffer = ""
+    in_tag = False
+    for block in blocks:
+        for i, chunk in enumerate(block.split("<")):
+            if i > 0:
+                in_tag = True
+                if buffer: yield Text(buffer)
+                buffer = ""
+            pieces = chunk.split(">")
+            buffer += pieces[0]
+            for piece in pieces[1:]:
+                in_tag = False
+                yield Tag(buffer)
+                buffer = piece
+        if not in_tag:
+            cut = len(buffer)
+            while cut > 0 and not buffer[cut - 1].isspace():
+                cut -= 1
+            if cut:
+                yield Text(buffer[:cut])
+                buffer = buffer[cut:]
+    if not in_tag and buffer:
+        yield Text(buffer)
+
 FONTS = {}
 
 def get_font(size, weight, style):
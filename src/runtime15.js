@@ -3,6 +3,12 @@ window.console = { log: function(x) { call_python("log", x); } }
 window.document = { querySelectorAll: function(s) {
     var handles = call_python("querySelectorAll", s, window._id);
     return handles.map(function(h) { return new window.Node(h) });
+}, getElementById: function(id) {
+    var handle = call_python("getElementById", id, window._id);
+    return handle < 0 ? null : new window.Node(handle);
+}, getElementsByClassName: function(name) {
+    var handles = call_python("getElementsByClassName", name, window._id);
+    return handles.map(function(h) { return new window.Node(h) });
 }}
 
 window.Node = function(handle) { this.handle = handle; }
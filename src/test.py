@@ -21,6 +21,7 @@ class socket:
     def __init__(self, *args, **kwargs):
         self.request = b""
         self.connected = False
+        self.responded = False
 
     def connect(self, host_port):
         self.scheme = "http"
@@ -28,6 +29,9 @@ class socket:
         self.connected = True
 
     def send(self, text):
+        if self.responded:
+            self.request = b""
+            self.responded = False
         self.request += text
         self.method, self.path, _ = self.request.decode("latin1").split(" ", 2)
         
@@ -47,6 +51,7 @@ class socket:
         else:
             url = self.scheme + "://" + self.host + ":" + str(self.port) + self.path
         self.Requests.setdefault(url, []).append(self.request)
+        self.responded = True
         assert url in self.URLs, f"Unknown URL {url}, only know {', '.join(self.URLs.keys())}"
         assert self.method == self.URLs[url][0], f"Made a {self.method} request to {url}, should be {self.URLs[url][0]}"
         output = self.URLs[url][1]
@@ -64,9 +69,15 @@ class socket:
     def close(self):
         self.connected = False
 
+    @staticmethod
+    def getaddrinfo(host, port, family=0, type=0, proto=0, flags=0):
+        return [(family, type, proto, "", (host, port))]
+
     @classmethod
     def patch(cls):
-        return mock.patch("socket.socket", wraps=cls)
+        return mock.patch.multiple("socket",
+            socket=mock.MagicMock(wraps=cls),
+            getaddrinfo=mock.MagicMock(wraps=cls.getaddrinfo))
 
     @classmethod
     def respond(cls, url, response, method="GET", body=None):
@@ -105,15 +116,77 @@ class socket:
         cls.Requests = {}
 
 class ssl:
-    def wrap_socket(self, s, server_hostname):
+    def wrap_socket(self, s, server_hostname, session=None):
         assert s.host == server_hostname
         s.scheme = "https"
+        s.session_reused = session == "session:" + server_hostname
+        s.session = "session:" + server_hostname
         return s
 
     @classmethod
     def patch(cls):
         return mock.patch("ssl.create_default_context", wraps=cls)
 
+class TLSServer:
+    """A real HTTPS server on localhost, signed by a throwaway CA.
+
+    Requires the `openssl` command, and the socket, ssl, and lock
+    patches must be stopped while it runs. `available` is False when
+    this machine can't serve TLS on localhost."""
+
+    def __init__(self, response, connections):
+        import os, shutil, socket, ssl, subprocess, tempfile
+        self.directory = tempfile.mkdtemp()
+        def path(name): return os.path.join(self.directory, name)
+        def openssl(*args):
+            subprocess.run(["openssl"] + list(args), check=True,
+                           capture_output=True, cwd=self.directory)
+        with open(path("server.ext"), "w") as f:
+            f.write("subjectAltName=DNS:localhost\n")
+            f.write("authorityKeyIdentifier=keyid\n")
+        openssl("req", "-x509", "-newkey", "rsa:2048", "-nodes", "-days", "1",
+                "-subj", "/CN=Test CA", "-keyout", "ca.key", "-out", "ca.pem")
+        openssl("req", "-newkey", "rsa:2048", "-nodes", "-subj", "/CN=localhost",
+                "-keyout", "server.key", "-out", "server.csr")
+        openssl("x509", "-req", "-in", "server.csr", "-days", "1",
+                "-CA", "ca.pem", "-CAkey", "ca.key", "-CAcreateserial",
+                "-extfile", "server.ext", "-out", "server.pem")
+        self.ca_file = path("ca.pem")
+
+        try:
+            self.context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+            self.context.load_cert_chain(path("server.pem"), path("server.key"))
+            self.listener = socket.create_server(("localhost", 0))
+        except (OSError, ssl.SSLError):
+            shutil.rmtree(self.directory)
+            self.available = False
+            return
+        self.available = True
+        # A client that gives up early mustn't leave join() waiting
+        self.listener.settimeout(10)
+        self.url = "https://localhost:{}/".format(self.listener.getsockname()[1])
+        self.response = response
+        self.connections = connections
+        self.thread = threading.Thread(target=self.serve)
+        self.thread.start()
+
+    def serve(self):
+        try:
+            for i in range(self.connections):
+                conn, addr = self.listener.accept()
+                with self.context.wrap_socket(conn, server_side=True) as s:
+                    request = b""
+                    while b"\r\n\r\n" not in request:
+                        request += s.recv(4096)
+                    s.sendall(self.response)
+        finally:
+            self.listener.close()
+
+    def join(self):
+        import shutil
+        self.thread.join()
+        shutil.rmtree(self.directory)
+
 class SilentTk:
     def bind(self, event, callback):
         pass
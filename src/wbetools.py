@@ -1,4 +1,5 @@
 import dis
+import os
 
 def record(type, *args):
     pass
@@ -76,13 +77,14 @@ FORCE_CROSS_ORIGIN_IFRAMES = False
 ASSERT_LAYOUT_CLEAN = False
 PRINT_INVALIDATION_DEPENDENCIES = False
 OUTPUT_TRACE = False
+PROFILE_DIRECTORY = os.path.join(os.path.expanduser("~"), ".wbe-profile")
 
 def parse_flags():
     import argparse, sys
     global SHOW_COMPOSITED_LAYER_BORDERS, \
         USE_COMPOSITING, USE_GPU, USE_BROWSER_THREAD, \
         FORCE_CROSS_ORIGIN_IFRAMES, ASSERT_LAYOUT_CLEAN, \
-        PRINT_INVALIDATION_DEPENDENCIES, OUTPUT_TRACE
+        PRINT_INVALIDATION_DEPENDENCIES, OUTPUT_TRACE, PROFILE_DIRECTORY
 
     parser = argparse.ArgumentParser(description='Chapter 13 code')
     parser.add_argument("url", type=str, help="URL to load")
@@ -102,6 +104,8 @@ def parse_flags():
         default=False, help="Whether to print out all invalidation dependencies")
     parser.add_argument("--trace", action="store_true",
         default=False, help="Whether to output a browser.trace file")
+    parser.add_argument("--profile", type=str, default=PROFILE_DIRECTORY,
+        help="Directory for this browser profile's caches")
     args = parser.parse_args()
 
     USE_BROWSER_THREAD = not args.single_threaded
@@ -112,5 +116,6 @@ def parse_flags():
     ASSERT_LAYOUT_CLEAN = args.assert_layout_clean
     PRINT_INVALIDATION_DEPENDENCIES = args.print_invalidation_dependencies
     OUTPUT_TRACE = args.trace
+    PROFILE_DIRECTORY = args.profile
 
     sys.argv = [sys.argv[0], args.url]